@@ -0,0 +1,299 @@
+"""
+Banco de pruebas de carga sin Telegram.
+
+Crea un casino.db temporal, un Bot falso que registra cada llamada a la API y
+Updates sintéticos, y mide apostar, regalar, ranking y spin_and_settle con N
+grupos, M usuarios y K apuestas por ronda:
+
+    python bench.py --chats 1000 --users 5000 --bets 100 --rounds 3 --json bench.json
+    python bench.py --compare bench.json          # compara con una ejecución anterior
+    python bench.py --storage memory              # sin disco (ver storage.py)
+
+Informa del throughput y de la latencia p50/p95/p99 por handler y por función
+de db.py. Con --json guarda el resultado para comparar versiones.
+"""
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+ADMIN_ID = 2
+BET_TOKENS = ("rojo", "negro", "par", "impar", "docena1", "columna2", "17", "0", "1-2", "4-5-6", "1-2-4-5")
+
+
+class FakeRequest(BaseRequest):
+    """BaseRequest que responde a la API de Bot sin red y cuenta las llamadas por método."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return 1
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint in ("sendMessage", "editMessageText"):
+            result = {"message_id": next(self._message_ids), "date": 0, "text": params.get("text", ""),
+                      "chat": {"id": int(params.get("chat_id", 0)), "type": "group"}}
+        elif endpoint == "getChatAdministrators":
+            result = [{"status": "administrator", "can_be_edited": False, "is_anonymous": False,
+                       "can_manage_chat": True, "can_delete_messages": True, "can_manage_video_chats": True,
+                       "can_restrict_members": True, "can_promote_members": True, "can_change_info": True,
+                       "can_invite_users": True,
+                       "user": {"id": ADMIN_ID, "is_bot": False, "first_name": "Admin"}}]
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+# -------------------------
+# Updates sintéticos
+# -------------------------
+_ids = itertools.count(1)
+
+
+def command(text: str, chat_id: int, user_id: int, reply_to_user: int = None) -> dict:
+    message = {
+        "message_id": next(_ids), "date": 0, "text": text,
+        "chat": {"id": chat_id, "type": "supergroup"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"Jugador{user_id}"},
+        "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+    }
+    if reply_to_user is not None:
+        message["reply_to_message"] = {
+            "message_id": next(_ids), "date": 0, "text": "hola",
+            "chat": {"id": chat_id, "type": "supergroup"},
+            "from": {"id": reply_to_user, "is_bot": False, "first_name": f"Jugador{reply_to_user}"},
+        }
+    return {"update_id": next(_ids), "message": message}
+
+
+def bench_env(concurrency: int) -> dict:
+    """Entorno para importar bot sin límites de salida ni de entrada y con giros sólo a mano."""
+    return {
+        "ROUND_INTERVAL_SECONDS": "3600",
+        "CONCURRENT_UPDATES": str(concurrency),
+        "OUTBOX_GLOBAL_RATE": "1000000",
+        "OUTBOX_CHAT_PER_MINUTE": "1000000",
+        "OUTBOX_CHAT_BURST": "1000000",
+        "OUTBOX_MAX_QUEUE": "10000000",
+        "THROTTLE_USER_PER_MINUTE": "1000000",
+        "THROTTLE_USER_BURST": "1000000",
+        "THROTTLE_CHAT_PER_MINUTE": "1000000",
+        "THROTTLE_CHAT_BURST": "1000000",
+        "THROTTLE_MERGE_SECONDS": "0",
+    }
+
+
+# -------------------------
+# Medidas
+# -------------------------
+def percentile(sorted_samples, p: float) -> float:
+    """Percentil por rango más cercano sobre una lista ya ordenada."""
+    if not sorted_samples:
+        return 0.0
+    rank = max(0, min(len(sorted_samples) - 1, math.ceil(p * len(sorted_samples) / 100) - 1))
+    return sorted_samples[rank]
+
+
+def summarize(samples, wall: float = None) -> dict:
+    """Resumen en milisegundos; throughput en operaciones/segundo si se conoce el tiempo de la fase."""
+    ordered = sorted(samples)
+    summary = {
+        "count": len(ordered),
+        "mean_ms": 1000 * sum(ordered) / len(ordered) if ordered else 0.0,
+        "p50_ms": 1000 * percentile(ordered, 50),
+        "p95_ms": 1000 * percentile(ordered, 95),
+        "p99_ms": 1000 * percentile(ordered, 99),
+        "max_ms": 1000 * ordered[-1] if ordered else 0.0,
+    }
+    if wall:
+        summary["throughput"] = len(ordered) / wall
+    return summary
+
+
+def instrument(module, samples):
+    """Envuelve cada función async pública de `module` para medir su latencia."""
+    for name in dir(module):
+        fn = getattr(module, name)
+        if name.startswith("_") or not asyncio.iscoroutinefunction(fn):
+            continue
+
+        @functools.wraps(fn)
+        async def timed(*args, _fn=fn, _name=name, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await _fn(*args, **kwargs)
+            finally:
+                samples[_name].append(time.perf_counter() - started)
+
+        setattr(module, name, timed)
+
+
+async def run_phase(name, app, updates, concurrency, samples, walls):
+    """Procesa `updates` con hasta `concurrency` a la vez, como concurrent_updates."""
+    from telegram import Update
+
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(data):
+        async with slots:
+            update = Update.de_json(data, app.bot)
+            started = time.perf_counter()
+            await app.process_update(update)
+            samples[name].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(data) for data in updates))
+    walls[name] += time.perf_counter() - started
+
+
+async def run_settle(bot, chats, concurrency, samples, walls):
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(chat_id):
+        async with slots:
+            started = time.perf_counter()
+            await bot.spin_and_settle(chat_id)
+            samples["spin_and_settle"].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(chat_id) for chat_id in chats))
+    walls["spin_and_settle"] += time.perf_counter() - started
+
+
+async def bench(args) -> dict:
+    import bot
+    import db
+
+    db_samples = defaultdict(list)
+    instrument(db, db_samples)
+    samples, walls = defaultdict(list), Counter()
+    rng = random.Random(args.seed)
+    request = FakeRequest()
+    app = bot.build_app(request=request)
+    chats = [-1000 - i for i in range(args.chats)]
+    users = [1000 + i for i in range(args.users)]
+
+    started = time.perf_counter()
+    await app.initialize()
+    await bot.post_init(app)
+    await app.start()
+    try:
+        await run_phase("ruleta_on", app, [command("/ruleta_on", c, ADMIN_ID) for c in chats],
+                        args.concurrency, samples, walls)
+        for _ in range(args.rounds):
+            bets = [command(f"/apostar {rng.randint(1, 10)} {rng.choice(BET_TOKENS)}", c, rng.choice(users))
+                    for _ in range(args.bets) for c in chats]
+            rng.shuffle(bets)
+            await run_phase("apostar", app, bets, args.concurrency, samples, walls)
+            gifts = [command(f"/regalar {rng.randint(1, 5)}", c, rng.choice(users), reply_to_user=rng.choice(users))
+                     for _ in range(args.gifts) for c in chats]
+            await run_phase("regalar", app, gifts, args.concurrency, samples, walls)
+            rankings = [command(f"/ranking {rng.choice(['', 'grupo', 'hoy'])}".strip(), c, rng.choice(users))
+                        for _ in range(args.rankings) for c in chats]
+            await run_phase("ranking", app, rankings, args.concurrency, samples, walls)
+            await run_settle(bot, chats, args.concurrency, samples, walls)
+    finally:
+        await app.stop()
+        await bot.post_stop(app)
+        await app.shutdown()
+        await bot.post_shutdown(app)
+    wall = time.perf_counter() - started
+
+    updates = sum(len(v) for k, v in samples.items() if k != "spin_and_settle")
+    return {
+        "config": vars(args),
+        "wall_seconds": wall,
+        "updates": updates,
+        "updates_per_second": updates / wall,
+        "handlers": {name: summarize(s, walls[name]) for name, s in sorted(samples.items())},
+        "db": {name: summarize(s) for name, s in sorted(db_samples.items())},
+        "api_calls": dict(request.calls),
+        "ledger": bot.ledger.stats(),
+        "outbox": bot.outbox.stats(),
+    }
+
+
+def print_report(result: dict, baseline: dict = None):
+    def rows(section):
+        for name, s in result[section].items():
+            line = f"  {name:<22} n={s['count']:<7} p50={s['p50_ms']:8.2f}ms p95={s['p95_ms']:8.2f}ms " \
+                   f"p99={s['p99_ms']:8.2f}ms"
+            if "throughput" in s:
+                line += f"  {s['throughput']:9.1f}/s"
+            old = (baseline or {}).get(section, {}).get(name)
+            if old and old["p95_ms"]:
+                line += f"  p95 x{s['p95_ms'] / old['p95_ms']:.2f}"
+            print(line)
+
+    print(f"{result['updates']} updates en {result['wall_seconds']:.1f}s "
+          f"({result['updates_per_second']:.0f}/s)")
+    print("Handlers:")
+    rows("handlers")
+    print("db.py:")
+    rows("db")
+    print("API:", result["api_calls"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--bets", type=int, default=100, help="apuestas por ronda y grupo")
+    parser.add_argument("--gifts", type=int, default=5, help="/regalar por ronda y grupo")
+    parser.add_argument("--rankings", type=int, default=5, help="/ranking por ronda y grupo")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--storage", choices=("sqlite", "memory", "postgres"),
+                        help="STORAGE_BACKEND (por defecto el de .env)")
+    parser.add_argument("--json", help="guarda el resultado en este fichero")
+    parser.add_argument("--compare", help="resultado anterior (--json) para comparar p95")
+    args = parser.parse_args()
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    # Antes de importar bot
+    os.environ.setdefault("BOT_TOKEN", "1:bench")
+    os.environ.update(bench_env(args.concurrency))
+    if args.storage:
+        os.environ["STORAGE_BACKEND"] = args.storage
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory(prefix="tilin-bench-") as tmp:
+        os.chdir(tmp)  # casino.db, diario y archivo van al directorio temporal
+        result = asyncio.run(bench(args))
+    print_report(result, baseline)
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.error import TelegramError
+
+from cache import TTLCache
+from outbox import NORMAL
+
+logger = logging.getLogger(__name__)
+
+# callback_data de los botones: "c:<ficha>" elige ficha, "b:<apuesta>" apuesta
+CHIP_PREFIX = "c:"
+BET_PREFIX = "b:"
+CALLBACK_PATTERN = r"^[cb]:"
+
+BOARD_BETS = (
+    ("rojo", "negro"),
+    ("par", "impar"),
+    ("bajo", "alto"),
+    ("docena1", "docena2", "docena3"),
+    ("columna1", "columna2", "columna3"),
+)
+LABELS = {"rojo": "🔴 rojo", "negro": "⚫ negro"}
+TOP_BETS_SHOWN = 8
+
+
+class _Table:
+    __slots__ = ("message_id", "round_id", "totals", "players", "dirty", "last_edit", "timer", "creating")
+
+    def __init__(self, round_id):
+        self.message_id = None
+        self.round_id = round_id
+        self.totals = Counter()    # apuesta -> fichas en la ronda
+        self.players = set()
+        self.dirty = False
+        self.last_edit = 0.0
+        self.timer = None          # edición diferida pendiente
+        self.creating = False      # el mensaje está en la cola de salida
+
+
+class BetBoard:
+    """
+    Tablero de apuestas con teclado inline: un único mensaje fijado por mesa
+    activa. Cada ronda reutiliza el mismo mensaje; los totales se actualizan
+    editándolo como mucho una vez cada `edit_interval` segundos, así que una
+    ronda cuesta O(1) mensajes salientes en vez de uno por apuesta.
+    La ficha elegida por cada jugador se guarda aparte (el teclado es común).
+    """
+
+    def __init__(self, outbox, chips=(10, 50, 100, 500), edit_interval: float = 3.0,
+                 pin: bool = True, max_players: int = 100_000, on_created=None):
+        self.outbox = outbox
+        self.on_created = on_created   # callback(chat_id, message_id) al enviar un tablero nuevo
+        self.chips = tuple(chips)
+        self.edit_interval = edit_interval
+        self.pin = pin
+        self._bot = None
+        self._tables = {}
+        self._tasks = set()   # fijar/desfijar en curso (referencia fuerte)
+        self._chips = TTLCache(maxsize=max_players, ttl=3600)  # (chat_id, user_id) -> ficha
+        self.keyboard = InlineKeyboardMarkup(
+            [[InlineKeyboardButton(f"🪙 {chip}", callback_data=f"{CHIP_PREFIX}{chip}") for chip in self.chips]]
+            + [[InlineKeyboardButton(LABELS.get(bet, bet), callback_data=f"{BET_PREFIX}{bet}") for bet in row]
+               for row in BOARD_BETS]
+        )
+        self.edits = 0
+
+    def start(self, bot):
+        self._bot = bot
+
+    def stop(self):
+        for table in self._tables.values():
+            if table.timer:
+                table.timer.cancel()
+
+    # ---- fichas ----
+    def chip(self, chat_id: int, user_id: int) -> int:
+        return self._chips.get((chat_id, user_id)) or self.chips[0]
+
+    def set_chip(self, chat_id: int, user_id: int, chip: int) -> bool:
+        if chip not in self.chips:
+            return False
+        self._chips.set((chat_id, user_id), chip)
+        return True
+
+    # ---- mesas ----
+    def is_open(self, chat_id: int) -> bool:
+        return chat_id in self._tables
+
+    def open(self, chat_id: int, round_id: int):
+        """Mesa activada: envía (y fija) el tablero, o lo reutiliza si ya existe."""
+        table = self._tables.get(chat_id)
+        if table is None:
+            table = self._tables[chat_id] = _Table(round_id)
+        else:
+            self._reset(table, round_id)
+        self._touch(chat_id, table, now=True)
+
+    def restore(self, chat_id: int, round_id: int, message_id: int):
+        """Tras un reinicio: reutiliza el tablero ya enviado sin llamar a la API; se edita en la siguiente ronda."""
+        table = self._tables[chat_id] = _Table(round_id)
+        table.message_id = message_id
+
+    def new_round(self, chat_id: int, round_id: int):
+        table = self._tables.get(chat_id)
+        if table is not None:
+            self._reset(table, round_id)
+            self._touch(chat_id, table, now=True)
+
+    def record(self, chat_id: int, round_id: int, user_id: int, bets):
+        """Suma al tablero las apuestas [(CompiledBet, cantidad), ...] aceptadas."""
+        table = self._tables.get(chat_id)
+        if table is None or table.round_id != round_id:
+            return
+        for bet, amount in bets:
+            table.totals[bet.token] += amount
+        table.players.add(user_id)
+        self._touch(chat_id, table)
+
+    def close(self, chat_id: int):
+        """Mesa desactivada: quita el teclado y desfija el mensaje."""
+        table = self._tables.pop(chat_id, None)
+        if table is None:
+            return
+        if table.timer:
+            table.timer.cancel()
+        if table.message_id is not None:
+            self.outbox.edit(chat_id, table.message_id, "⏹️ Ruleta desactivada.")
+            if self.pin:
+                self._spawn(self._call(self._bot.unpin_chat_message, chat_id, table.message_id))
+
+    def stats(self) -> dict:
+        return {"tables": len(self._tables), "edits": self.edits}
+
+    # ---- internos ----
+    @staticmethod
+    def _reset(table: _Table, round_id: int):
+        table.round_id = round_id
+        table.totals.clear()
+        table.players.clear()
+
+    def _render(self, table: _Table) -> str:
+        lines = [f"🎰 <b>Mesa de ruleta — Ronda #{table.round_id}</b>"]
+        total = sum(table.totals.values())
+        if total:
+            lines.append(f"💰 {total} fichas · 👥 {len(table.players)} jugadores")
+            for token, amount in table.totals.most_common(TOP_BETS_SHOWN):
+                lines.append(f"• {token}: {amount}")
+        else:
+            lines.append("Aún no hay apuestas. Elige ficha y toca una apuesta.")
+        return "\n".join(lines)
+
+    def _touch(self, chat_id: int, table: _Table, now: bool = False):
+        """Marca el tablero como cambiado y planifica la edición respetando edit_interval."""
+        table.dirty = True
+        if table.message_id is None:
+            if not table.creating:
+                table.creating = True
+                table.dirty = False
+                self.outbox.send(chat_id, self._render(table), parse_mode=ParseMode.HTML,
+                                 reply_markup=self.keyboard,
+                                 on_sent=lambda message: self._created(chat_id, table, message))
+            return
+        if table.timer is not None:
+            if not now:
+                return
+            table.timer.cancel()
+        delay = 0.0 if now else max(0.0, table.last_edit + self.edit_interval - time.monotonic())
+        table.timer = asyncio.get_running_loop().call_later(delay, self._edit, chat_id, table)
+
+    def _created(self, chat_id: int, table: _Table, message):
+        table.creating = False
+        if self._tables.get(chat_id) is not table:
+            return  # se desactivó mientras se enviaba
+        table.message_id = message.message_id
+        table.last_edit = time.monotonic()
+        if self.on_created:
+            self.on_created(chat_id, message.message_id)
+        if self.pin:
+            self._spawn(self._call(self._bot.pin_chat_message, chat_id, message.message_id,
+                                   disable_notification=True))
+        if table.dirty:
+            self._touch(chat_id, table)
+
+    def _edit(self, chat_id: int, table: _Table):
+        table.timer = None
+        if not table.dirty or self._tables.get(chat_id) is not table:
+            return
+        table.dirty = False
+        table.last_edit = time.monotonic()
+        self.edits += 1
+        self.outbox.edit(chat_id, table.message_id, self._render(table), priority=NORMAL,
+                         parse_mode=ParseMode.HTML, reply_markup=self.keyboard)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    async def _call(method, *args, **kwargs):
+        # Fijar/desfijar necesita permisos de admin; sin ellos el tablero sigue funcionando
+        try:
+            await method(*args, **kwargs)
+        except TelegramError:
+            logger.warning("No se pudo fijar/desfijar el tablero en %s", args[0], exc_info=True)
+        except Exception:
+            logger.exception("Error fijando/desfijando el tablero en %s", args[0])
@@ -1,22 +1,167 @@
 # bot.py  - Reemplaza tu archivo actual por este
 import os
+import asyncio
+import datetime
 import logging
+import signal
+import time
+from collections import Counter
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.constants import ParseMode
-from telegram.ext import Application, CommandHandler, ContextTypes
+from telegram.ext import (
+    Application,
+    ApplicationHandlerStop,
+    CallbackQueryHandler,
+    ChatMemberHandler,
+    CommandHandler,
+    ContextTypes,
+    TypeHandler,
+)
 
 import db
+import retention
 import roulette
+from chatstats import BLACK, GREEN, HISTORY_SIZE, RED
+from board import BET_PREFIX, CALLBACK_PATTERN, CHIP_PREFIX, BetBoard
+from cache import TTLCache
+from directory import UserDirectory
+from lanes import ChatLanes
+from leaderboard import PERIODS, Leaderboards, week_start
+from ledger import Ledger, SharedLedger
+from metrics import COUNT_BUCKETS, Metrics
+from outbox import ACK, RESULT, Outbox
+from scheduler import RoundScheduler
+from throttle import Throttle
+from webhook import WebhookServer, resolve_secret
 
 load_dotenv()
 TOKEN = os.getenv("BOT_TOKEN")
 ROUND_INTERVAL_SECONDS = int(os.getenv("ROUND_INTERVAL_SECONDS", "120"))
+MIN_ROUND_INTERVAL_SECONDS = 15
+MAX_ROUND_INTERVAL_SECONDS = 3600
+# polling (por defecto) o webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Updates procesados a la vez (cada chat sigue yendo en orden por su carril)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+# Modo con varios procesos (shard.py): este proceso es el shard SHARD_INDEX de SHARD_COUNT
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+# memory: saldos en memoria con diario (un proceso); shared: directo en SQLite (varios procesos)
+LEDGER_MODE = os.getenv("LEDGER_MODE", "shared" if SHARD_COUNT > 1 else "memory").lower()
+LEADERBOARD_REFRESH_SECONDS = int(os.getenv("LEADERBOARD_REFRESH_SECONDS", "30"))
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))
+OUTBOX_CHAT_PER_MINUTE = float(os.getenv("OUTBOX_CHAT_PER_MINUTE", "20"))
+OUTBOX_CHAT_BURST = int(os.getenv("OUTBOX_CHAT_BURST", "3"))
+OUTBOX_COALESCE_SECONDS = float(os.getenv("OUTBOX_COALESCE_SECONDS", "1.5"))
+OUTBOX_MAX_QUEUE = int(os.getenv("OUTBOX_MAX_QUEUE", "10000"))
+ADMIN_CACHE_TTL = int(os.getenv("ADMIN_CACHE_TTL", "300"))
+ADMIN_CACHE_SIZE = int(os.getenv("ADMIN_CACHE_SIZE", "10000"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "100000"))
+# Pares <cantidad> <tipo> aceptados en un solo /apostar
+MAX_BETS_PER_COMMAND = int(os.getenv("MAX_BETS_PER_COMMAND", "20"))
+# Tablero con botones: mensaje fijado por mesa, editado como mucho cada BOARD_EDIT_SECONDS
+BOARD_ENABLED = os.getenv("BOARD_ENABLED", "1") == "1"
+BOARD_PIN = os.getenv("BOARD_PIN", "1") == "1"
+BOARD_EDIT_SECONDS = float(os.getenv("BOARD_EDIT_SECONDS", "3"))
+BOARD_CHIPS = tuple(int(x) for x in os.getenv("BOARD_CHIPS", "10,50,100,500").split(","))
+# Límite de comandos entrantes por usuario y por grupo (lo que exceda se ignora)
+THROTTLE_USER_PER_MINUTE = float(os.getenv("THROTTLE_USER_PER_MINUTE", "20"))
+THROTTLE_USER_BURST = int(os.getenv("THROTTLE_USER_BURST", "5"))
+THROTTLE_CHAT_PER_MINUTE = float(os.getenv("THROTTLE_CHAT_PER_MINUTE", "120"))
+THROTTLE_CHAT_BURST = int(os.getenv("THROTTLE_CHAT_BURST", "20"))
+THROTTLE_MERGE_SECONDS = float(os.getenv("THROTTLE_MERGE_SECONDS", "2"))
+# Métricas Prometheus en http://METRICS_LISTEN:METRICS_PORT/metrics (0 = desactivado)
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Perfilado por muestreo: guarda un .prof en PROFILE_DIR para PROFILE_RATE de las llamadas al handler
+PROFILE_HANDLER = os.getenv("PROFILE_HANDLER", "")
+PROFILE_RATE = float(os.getenv("PROFILE_RATE", "0.01"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Saldos en memoria con diario; se vuelcan a SQLite cada N segundos o M operaciones
+LEDGER_FLUSH_INTERVAL = float(os.getenv("LEDGER_FLUSH_INTERVAL", "1"))
+LEDGER_FLUSH_SIZE = int(os.getenv("LEDGER_FLUSH_SIZE", "500"))
+LEDGER_FSYNC = os.getenv("LEDGER_FSYNC", "always").lower()
+# Cada cuánto se comprueban los saldos contra el historial y se guarda un checkpoint
+CHECKPOINT_INTERVAL_SECONDS = int(os.getenv("CHECKPOINT_INTERVAL_SECONDS", "3600"))
+# Rondas liquidadas hace más de RETENTION_DAYS se archivan en ARCHIVE_DIR y se resumen por día
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", "30"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+COMPACTION_INTERVAL_SECONDS = int(os.getenv("COMPACTION_INTERVAL_SECONDS", "21600"))
+COMPACTION_BATCH = int(os.getenv("COMPACTION_BATCH", "2000"))
+# Al arrancar, las mesas que perdieron su giro con el bot parado giran repartidas en estos segundos
+RESTART_SPREAD_SECONDS = int(os.getenv("RESTART_SPREAD_SECONDS", "30"))
 
 # Logging básico (útil para depurar)
-logging.basicConfig(level=logging.WARNING)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
 logger = logging.getLogger(__name__)
 
+# Admins por chat (tupla de ChatMember). Se invalida con cada update de ChatMemberHandler.
+admin_cache = TTLCache(maxsize=ADMIN_CACHE_SIZE, ttl=ADMIN_CACHE_TTL)
+# Todos los mensajes salientes pasan por aquí (límites de Telegram, prioridades, agrupado)
+outbox = Outbox(
+    # El límite global de Telegram es por bot: se reparte entre los shards
+    global_rate=OUTBOX_GLOBAL_RATE / SHARD_COUNT,
+    chat_rate=OUTBOX_CHAT_PER_MINUTE / 60,
+    chat_burst=OUTBOX_CHAT_BURST,
+    coalesce_seconds=OUTBOX_COALESCE_SECONDS,
+    max_queue=OUTBOX_MAX_QUEUE,
+)
+# Comandos entrantes: se descartan antes de llegar a los handlers (y a la BD)
+throttle = Throttle(
+    user_rate=THROTTLE_USER_PER_MINUTE / 60,
+    user_burst=THROTTLE_USER_BURST,
+    chat_rate=THROTTLE_CHAT_PER_MINUTE / 60,
+    chat_burst=THROTTLE_CHAT_BURST,
+    merge_seconds=THROTTLE_MERGE_SECONDS,
+    max_keys=USER_CACHE_SIZE,
+)
+# Comandos sin efectos: si se repiten seguidos basta con responder al primero
+IDEMPOTENT_COMMANDS = {"start", "saldo", "reglas", "ranking", "historial", "estadisticas", "listar_admins"}
+# Un carril por chat: rondas, apuestas y liquidaciones de un grupo van de una en una
+chat_lanes = ChatLanes()
+# Todas las mesas activas y sus próximos giros (un solo bucle para todos los grupos)
+# Latencias, contadores y perfilado (GET /metrics en el servidor de métricas)
+metrics = Metrics()
+metrics.profile(PROFILE_HANDLER, PROFILE_RATE, PROFILE_DIR)
+scheduler = RoundScheduler(
+    default_interval=ROUND_INTERVAL_SECONDS,
+    on_spin=lambda chat_id, lag: metrics.observe("scheduler_lag_seconds", lag),
+)
+# Tablero de apuestas con teclado inline (un mensaje por mesa activa)
+board = BetBoard(outbox, chips=BOARD_CHIPS, edit_interval=BOARD_EDIT_SECONDS, pin=BOARD_PIN,
+                 max_players=USER_CACHE_SIZE,
+                 # Se guarda para reutilizar el mismo mensaje tras un reinicio
+                 on_created=lambda chat_id, message_id: save_board_message(chat_id, message_id))
+# Escrituras lanzadas desde callbacks síncronos (referencia fuerte hasta que terminan)
+background_tasks = set()
+# Rankings en memoria, actualizados con cada cambio de saldo
+leaderboards = Leaderboards()
+# Saldos: se leen y cambian en memoria; el diario y los volcados los hacen duraderos
+if LEDGER_MODE == "shared":
+    ledger = SharedLedger(on_change=leaderboards.set_balance)
+else:
+    ledger = Ledger(
+        # Una BD en memoria empieza vacía: un diario en disco colaría saldos de otra ejecución
+        None if os.getenv("STORAGE_BACKEND", "sqlite").lower() == "memory" else db.DB_FILE.with_suffix(".journal"),
+        flush_interval=LEDGER_FLUSH_INTERVAL,
+        flush_size=LEDGER_FLUSH_SIZE,
+        fsync=LEDGER_FSYNC,
+        on_change=leaderboards.set_balance,
+    )
+# Nombres de usuarios conocidos: evita ensure_user en la BD y get_chat_member en la API
+directory = UserDirectory(maxsize=USER_CACHE_SIZE, on_new=ledger.open_account)
+# Ronda abierta de cada chat (chat_id -> round_id); la BD sigue siendo la fuente al arrancar
+open_rounds = {}
+# Apuestas aceptadas en la ronda abierta de cada chat (métrica bets_per_round)
+round_bets = Counter()
+
 
 # -------------------------
 # Helpers
@@ -30,6 +175,41 @@ def get_color_and_symbol(number: int):
     return "♠️", "Negro"
 
 
+def parse_amount(text: str) -> int:
+    """Cantidad de fichas de un comando: entero entre 1 y db.MAX_CHIPS; si no, ValueError."""
+    amount = int(text)
+    if not 0 < amount <= db.MAX_CHIPS:
+        raise ValueError(text)
+    return amount
+
+
+def reply(update: Update, text: str, **kwargs):
+    """Responde al mensaje del comando a través de la cola de salida."""
+    outbox.send(update.effective_chat.id, text, reply_to=update.effective_message.message_id, **kwargs)
+
+
+def save_board_message(chat_id: int, message_id: int):
+    """Guarda en segundo plano el mensaje del tablero; un fallo sólo se registra."""
+    async def save():
+        try:
+            await db.set_board_message(chat_id, message_id)
+        except Exception:
+            logger.exception("No se pudo guardar el tablero del chat %s", chat_id)
+
+    task = asyncio.create_task(save())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def get_admins(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
+    """Administradores del chat, desde la caché si no han caducado."""
+    admins = admin_cache.get(chat_id)
+    if admins is None:
+        admins = tuple(await context.bot.get_chat_administrators(chat_id))
+        admin_cache.set(chat_id, admins)
+    return admins
+
+
 async def es_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """True si el usuario que llamó el comando es admin/creator en el grupo."""
     try:
@@ -40,9 +220,8 @@ async def es_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
         if chat.type not in ("group", "supergroup"):
             return False
         try:
-            admins = await context.bot.get_chat_administrators(chat.id)
-            admin_ids = {a.user.id for a in admins}
-            return user.id in admin_ids
+            admins = await get_admins(chat.id, context)
+            return any(a.user.id == user.id for a in admins)
         except Exception:
             # fallback
             try:
@@ -54,39 +233,69 @@ async def es_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
         return False
 
 
+async def limitar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Grupo -1: corre antes que cualquier handler. Comandos y toques del tablero
+    que superan el límite del usuario o del grupo no siguen adelante.
+    """
+    user = update.effective_user
+    if user is None:
+        return
+    chat = update.effective_chat
+    query = update.callback_query
+    message = update.effective_message
+    if query is not None:
+        command = None
+    elif message is not None and message.text and message.text.startswith("/"):
+        name = message.text.split(maxsplit=1)[0][1:].split("@", 1)[0].lower()
+        command = " ".join(message.text.split()).lower() if name in IDEMPOTENT_COMMANDS else None
+    else:
+        return  # sólo se limitan comandos y toques
+    if throttle.allow(user.id, chat.id if chat else None, command):
+        return
+    if query is not None:
+        # Sin responder, el botón se queda cargando; la respuesta no toca la BD
+        await query.answer("⏳ Demasiado rápido, espera un momento.")
+    raise ApplicationHandlerStop
+
+
+async def on_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Alguien cambió de rol (o entró/salió): la lista de admins cacheada ya no vale."""
+    if update.effective_chat:
+        admin_cache.invalidate(update.effective_chat.id)
+
+
 # -------------------------
 # Comandos básicos
 # -------------------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db.init_db()
     user = update.effective_user
-    db.ensure_user(user.id, user.first_name or "")
-    await update.message.reply_text(f"🎰 Bienvenido {user.first_name}! Usa /saldo para ver tus fichas.")
+    await directory.ensure(user.id, user.first_name or "")
+    reply(update, f"🎰 Bienvenido {user.first_name}! Usa /saldo para ver tus fichas.")
 
 
 async def saldo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db.init_db()
     user = update.effective_user
-    db.ensure_user(user.id, user.first_name or "")
-    bal = db.get_balance(user.id)
-    await update.message.reply_text(f"💰 {user.first_name}, tu saldo es {bal} fichas.")
+    await directory.ensure(user.id, user.first_name or "")
+    bal = await ledger.get_balance(user.id)
+    reply(update, f"💰 {user.first_name}, tu saldo es {bal} fichas.")
 
 
 async def listar_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         chat = update.effective_chat
         if chat.type not in ("group", "supergroup"):
-            await update.message.reply_text("Este comando sólo funciona en grupos.")
+            reply(update, "Este comando sólo funciona en grupos.")
             return
-        admins = await context.bot.get_chat_administrators(chat.id)
+        admins = await get_admins(chat.id, context)
         lines = []
         for a in admins:
             uname = f" (@{a.user.username})" if getattr(a.user, "username", None) else ""
             lines.append(f"{a.user.id} — {a.user.first_name}{uname} — {a.status}")
-        await update.message.reply_text("Admins:\n" + "\n".join(lines))
+        reply(update, "Admins:\n" + "\n".join(lines))
     except Exception as e:
         logger.exception("listar_admins error")
-        await update.message.reply_text(f"Error al listar admins: {e}")
+        reply(update, f"Error al listar admins: {e}")
 
 
 # -------------------------
@@ -106,97 +315,148 @@ async def reglas(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• /apostar 50 par\n"
         "• /apostar 20 17\n"
         "• /apostar 10 1-2   (split de 2 números)\n"
-        "• /apostar 15 docena2\n\n"
+        "• /apostar 15 docena2\n"
+        "• /apostar 10 rojo 5 17 5 1-2   (varias apuestas de una vez)\n\n"
         "🎲 <b>Apuestas válidas (resumen)</b>:\n"
         "- Número único (straight) — paga 35:1\n"
-        "- Split (2 números con '-') — paga 17:1\n"
-        "- Street (3 números) — paga 11:1\n"
-        "- Corner (4 números) — paga 8:1\n"
-        "- Línea (6 números) — paga 5:1\n"
+        "- Split (2 números contiguos, ej. 1-2 o 0-3) — paga 17:1\n"
+        "- Street (una fila de 3, ej. 4-5-6) — paga 11:1\n"
+        "- Corner (4 números en cuadro, ej. 1-2-4-5) — paga 8:1\n"
+        "- Línea (dos filas, ej. 1-2-3-4-5-6) — paga 5:1\n"
         "- Docenas: docena1 (1-12), docena2 (13-24), docena3 (25-36) — paga 2:1\n"
         "- Columnas: columna1/2/3 — paga 2:1\n"
         "- Bajo (1-18) / Alto (19-36) — paga 1:1\n"
         "- Rojo / Negro, Par / Impar — paga 1:1\n\n"
+        "🎛️ Con la ruleta activa, el mensaje fijado tiene botones: elige ficha y toca la apuesta.\n"
         "📝 Usa /saldo para ver tu saldo, /ranking para ver el top y /regalar para transferir fichas a otro jugador.\n"
+        "🏆 /ranking grupo — top de este grupo · /ranking hoy o /ranking semana — mayores ganadores.\n"
+        "📜 /historial [n] — últimos resultados del grupo · /estadisticas — números calientes, fríos y rachas.\n"
     )
-    await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
+    reply(update, msg, parse_mode=ParseMode.HTML)
 
 
 # -------------------------
 # Apostar (soporta muchos tipos)
 # -------------------------
+@chat_lanes.serialized
 async def apostar(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db.init_db()
     chat = update.effective_chat
     user = update.effective_user
-    db.ensure_user(user.id, user.first_name or "")
+    await directory.ensure(user.id, user.first_name or "")
 
     # Comprobar ruleta activa
-    try:
-        jobs = context.job_queue.get_jobs_by_name(f'ruleta:{chat.id}')
-    except Exception:
-        jobs = []
-    if not jobs:
-        await update.message.reply_text("⛔ La ruleta está apagada. No se aceptan apuestas ahora.")
+    if not scheduler.is_active(chat.id):
+        reply(update, "⛔ La ruleta está apagada. No se aceptan apuestas ahora.")
         return
 
-    if len(context.args) < 2:
-        await update.message.reply_text("Uso: /apostar <cantidad> <tipo>  — usa /reglas para ejemplos.")
+    args = context.args
+    if len(args) < 2 or len(args) % 2:
+        reply(update, "Uso: /apostar <cantidad> <tipo> [<cantidad> <tipo> ...]  — usa /reglas para ejemplos.")
+        return
+    if len(args) // 2 > MAX_BETS_PER_COMMAND:
+        reply(update, f"❌ Máximo {MAX_BETS_PER_COMMAND} apuestas por comando.")
         return
 
-    # parse amount
-    try:
-        amount = int(context.args[0])
-        if amount <= 0:
-            raise ValueError()
-    except Exception:
-        await update.message.reply_text("❌ La cantidad debe ser un número entero mayor a 0.")
+    # Se valida todo el lote antes de tocar el saldo: o entran todas o ninguna
+    bets = []
+    for i in range(0, len(args), 2):
+        try:
+            amount = parse_amount(args[i])
+        except Exception:
+            reply(update, f"❌ La cantidad debe ser un número entero entre 1 y {db.MAX_CHIPS} (\"{args[i]}\").")
+            return
+        # Validación de token: el compilador rechaza combinaciones que no existen en el paño
+        try:
+            bet = roulette.compile_bet(args[i + 1])
+        except ValueError:
+            reply(update, f"❌ Apuesta no válida: \"{args[i + 1]}\". Revisa /reglas para los tipos permitidos.")
+            return
+        bets.append((bet, amount))
+
+    # Registrar apuestas: un débito del total en memoria y un solo registro en el diario
+    round_id = open_rounds.get(chat.id)
+    if round_id is None:
+        reply(update, "⏳ La ronda se está cerrando. Intenta de nuevo en unos segundos.")
+        return
+    placed = await ledger.place_bet(chat.id, round_id, user.id, bets)
+    if placed.status == db.BET_ROUND_CLOSED:
+        # SharedLedger: la BD no tiene ronda abierta para el chat; no se descontó nada
+        reply(update, "⏳ La ronda se está cerrando. Intenta de nuevo en unos segundos.")
+        return
+    if placed.status == db.BET_INSUFFICIENT_FUNDS:
+        reply(update, "❌ Saldo insuficiente.")
         return
+    leaderboards.joined(chat.id, user.id, placed.balance)
+    board.record(chat.id, round_id, user.id, bets)
+    round_bets[chat.id] += len(bets)
 
-    bet_token = context.args[1].lower().strip()
-
-    # Validación de token
-    valid = False
-    if bet_token in ("rojo", "negro", "par", "impar", "bajo", "alto",
-                     "docena1", "docena2", "docena3",
-                     "columna1", "columna2", "columna3"):
-        valid = True
-    elif "-" in bet_token:
-        parts = bet_token.split("-")
-        if 2 <= len(parts) <= 6 and all(p.isdigit() and 0 <= int(p) <= 36 for p in parts):
-            valid = True
+    display_name = user.first_name or f"Jugador-{user.id}"
+    if len(bets) == 1:
+        text = f'✅ {display_name} apostó {amount} a {bet.token}. (Ronda #{round_id})'
     else:
-        if bet_token.isdigit():
-            n = int(bet_token)
-            if 0 <= n <= 36:
-                valid = True
+        legs = " · ".join(f"{amount} a {bet.token}" for bet, amount in bets)
+        total = sum(amount for _, amount in bets)
+        text = f'✅ {display_name} apostó {total} en {len(bets)} apuestas: {legs}. (Ronda #{round_id})'
+    # Las confirmaciones seguidas del mismo grupo salen agrupadas en un solo mensaje
+    reply(update, text, priority=ACK, coalesce=True)
 
-    if not valid:
-        await update.message.reply_text("❌ Apuesta no válida. Revisa /reglas para los tipos permitidos.")
-        return
 
-    balance = db.get_balance(user.id)
-    if amount > balance:
-        await update.message.reply_text("❌ Saldo insuficiente.")
+# -------------------------
+# Tablero (teclado inline)
+# -------------------------
+@chat_lanes.serialized
+async def tablero(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Toques en el tablero: elegir ficha o apostar la ficha elegida."""
+    query = update.callback_query
+    chat = update.effective_chat
+    user = update.effective_user
+    data = query.data or ""
+
+    if data.startswith(CHIP_PREFIX):
+        try:
+            chip = int(data[len(CHIP_PREFIX):])
+        except ValueError:
+            chip = 0
+        if not board.set_chip(chat.id, user.id, chip):
+            await query.answer("Ficha no válida.")
+            return
+        await query.answer(f"🪙 Ficha de {chip}")
         return
 
-    # Registrar apuesta
-    chat_id = chat.id
-    round_id = db.get_or_open_round(chat_id)
-    db.add_balance(user.id, -amount)
-    db.place_bet(chat_id, round_id, user.id, bet_token, amount)
+    round_id = open_rounds.get(chat.id)
+    if not scheduler.is_active(chat.id) or round_id is None:
+        await query.answer("⛔ La ruleta está apagada.", show_alert=True)
+        return
+    try:
+        bet = roulette.compile_bet(data[len(BET_PREFIX):])
+    except ValueError:
+        await query.answer("Apuesta no válida.")
+        return
 
-    display_name = user.first_name or f"Jugador-{user.id}"
-    await update.message.reply_text(f'✅ {display_name} apostó {amount} a {bet_token}. (Ronda #{round_id})')
+    await directory.ensure(user.id, user.first_name or "")
+    amount = board.chip(chat.id, user.id)
+    # Mismo camino que /apostar: débito condicional en memoria y registro en el diario
+    placed = await ledger.place_bet(chat.id, round_id, user.id, [(bet, amount)])
+    if placed.status == db.BET_ROUND_CLOSED:
+        await query.answer("⏳ La ronda se está cerrando. Intenta de nuevo.", show_alert=True)
+        return
+    if placed.status == db.BET_INSUFFICIENT_FUNDS:
+        await query.answer(f"❌ Saldo insuficiente ({placed.balance} fichas).", show_alert=True)
+        return
+    leaderboards.joined(chat.id, user.id, placed.balance)
+    board.record(chat.id, round_id, user.id, [(bet, amount)])
+    round_bets[chat.id] += 1
+    # La confirmación va en la respuesta al toque, no en un mensaje al grupo
+    await query.answer(f"✅ {amount} a {bet.token} (Ronda #{round_id}) · saldo {placed.balance}")
 
 
 # -------------------------
 # Dar fichas (admins)
 # -------------------------
+@chat_lanes.serialized
 async def dar(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db.init_db()
     if not await es_admin(update, context):
-        await update.message.reply_text("⛔ Solo los administradores pueden usar este comando.")
+        reply(update, "⛔ Solo los administradores pueden usar este comando.")
         return
 
     # Responder al mensaje -> /dar 500
@@ -205,55 +465,56 @@ async def dar(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # 🔒 Bloquear si es un bot
         if getattr(target_user, "is_bot", False):
-            await update.message.reply_text("❌ No puedes dar fichas a bots.")
+            reply(update, "❌ No puedes dar fichas a bots.")
             return
 
         try:
-            amount = int(context.args[0])
-            if amount <= 0:
-                raise ValueError()
+            amount = parse_amount(context.args[0])
         except Exception:
-            await update.message.reply_text("Uso: responde con /dar <cantidad> (cantidad válida).")
+            reply(update, "Uso: responde con /dar <cantidad> (cantidad válida).")
             return
-        db.ensure_user(target_user.id, target_user.first_name or "")
-        db.add_balance(target_user.id, amount)
-        await update.message.reply_text(f"✅ {target_user.first_name} recibió {amount} fichas.")
+        await directory.ensure(target_user.id, target_user.first_name or "")
+        if await ledger.credit(target_user.id, amount) is None:
+            reply(update, f"❌ El saldo pasaría del máximo ({db.MAX_CHIPS} fichas).")
+            return
+        reply(update, f"✅ {target_user.first_name} recibió {amount} fichas.")
         return
 
     # /dar <user_id> <cantidad>
     if len(context.args) >= 2:
         try:
             target_id = int(context.args[0])
-            amount = int(context.args[1])
-            if amount <= 0:
+            # user_id de Telegram: positivo y cabe en INTEGER/BIGINT
+            if not 0 < target_id < 2**63:
                 raise ValueError()
+            amount = parse_amount(context.args[1])
         except Exception:
-            await update.message.reply_text("Uso: /dar <user_id> <cantidad> (valores válidos).")
+            reply(update, "Uso: /dar <user_id> <cantidad> (valores válidos).")
             return
 
         # 🔒 Bloquear si es el bot
-        me = await context.bot.get_me()
-        if target_id == me.id:
-            await update.message.reply_text("❌ No puedes dar fichas al bot.")
+        if target_id == context.bot.id:
+            reply(update, "❌ No puedes dar fichas al bot.")
             return
 
-        db.ensure_user(target_id, "")
-        db.add_balance(target_id, amount)
-        await update.message.reply_text(f"✅ Usuario {target_id} recibió {amount} fichas.")
+        await directory.ensure(target_id, "")
+        if await ledger.credit(target_id, amount) is None:
+            reply(update, f"❌ El saldo pasaría del máximo ({db.MAX_CHIPS} fichas).")
+            return
+        reply(update, f"✅ Usuario {target_id} recibió {amount} fichas.")
         return
 
-    await update.message.reply_text("Uso: responde con /dar <cantidad> o /dar <user_id> <cantidad>")
+    reply(update, "Uso: responde con /dar <cantidad> o /dar <user_id> <cantidad>")
 
 
 
 # -------------------------
 # Regalar fichas (usuarios)
 # -------------------------
+@chat_lanes.serialized
 async def regalar(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db.init_db()
     giver = update.effective_user
-    db.ensure_user(giver.id, giver.first_name or "")
-    balance = db.get_balance(giver.id)
+    await directory.ensure(giver.id, giver.first_name or "")
 
     # Responder a mensaje: /regalar 50
     if update.message.reply_to_message and len(context.args) == 1:
@@ -261,107 +522,50 @@ async def regalar(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # 🔒 Bloquear si el destinatario es un bot
         if getattr(target_user, "is_bot", False):
-            await update.message.reply_text("❌ No puedes regalar fichas a bots.")
+            reply(update, "❌ No puedes regalar fichas a bots.")
             return
 
         try:
-            amount = int(context.args[0])
-            if amount <= 0:
-                raise ValueError()
+            amount = parse_amount(context.args[0])
         except Exception:
-            await update.message.reply_text("Uso: responde al mensaje con /regalar <cantidad> (entero positivo).")
+            reply(update, "Uso: responde al mensaje con /regalar <cantidad> (entero positivo).")
             return
 
-        if amount > balance:
-            await update.message.reply_text("❌ No tienes saldo suficiente para regalar esa cantidad.")
+        await directory.ensure(target_user.id, target_user.first_name or "")
+        # Débito condicional y abono en un solo registro del diario: no hay carrera entre comprobar y descontar
+        if await ledger.transfer(giver.id, target_user.id, amount) is None:
+            reply(update, "❌ No tienes saldo suficiente o el saldo del destinatario pasaría del máximo.")
             return
-
-        db.ensure_user(target_user.id, target_user.first_name or "")
-        db.add_balance(giver.id, -amount)
-        db.add_balance(target_user.id, amount)
-        await update.message.reply_text(f"🎁 {giver.first_name} regaló {amount} fichas a {target_user.first_name}.")
+        reply(update, f"🎁 {giver.first_name} regaló {amount} fichas a {target_user.first_name}.")
         return
 
     # Forma alternativa no implementada: por user_id (podría añadirse)
-    await update.message.reply_text("Uso: responde al mensaje del usuario con /regalar <cantidad>")
+    reply(update, "Uso: responde al mensaje del usuario con /regalar <cantidad>")
 
 
 
 # -------------------------
 # Ejecutar ruleta y liquidar
 # -------------------------
-async def spin_and_settle(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    chat_id = job.chat_id
-    db.init_db()
+@metrics.timed_call("settle_seconds")
+async def spin_and_settle(chat_id: int):
+    """Gira la ruleta de chat_id; lo llama el scheduler en cada turno de la mesa."""
     result = roulette.spin()
-    round_id = db.close_round(chat_id, str(result))
-    if not round_id:
-        db.get_or_open_round(chat_id)
-        return
-
-    bets = db.get_bets(round_id)
-    winners = []  # (user_id, premio)
-
-    for user_id, bet_type, amount in bets:
-        win = 0
-        # Even-money bets (1:1 -> multiplier 2)
-        if bet_type == "rojo" and roulette.is_red(result):
-            win = amount * 2
-        elif bet_type == "negro" and (not roulette.is_red(result)) and result != 0:
-            win = amount * 2
-        elif bet_type == "par" and result != 0 and result % 2 == 0:
-            win = amount * 2
-        elif bet_type == "impar" and result % 2 == 1:
-            win = amount * 2
-        elif bet_type == "bajo" and 1 <= result <= 18:
-            win = amount * 2
-        elif bet_type == "alto" and 19 <= result <= 36:
-            win = amount * 2
-
-        # Docenas (paga 2:1 -> multiplier 3)
-        elif bet_type.startswith("docena"):
-            if bet_type == "docena1" and 1 <= result <= 12:
-                win = amount * 3
-            if bet_type == "docena2" and 13 <= result <= 24:
-                win = amount * 3
-            if bet_type == "docena3" and 25 <= result <= 36:
-                win = amount * 3
-
-        # Columnas (paga 2:1 -> multiplier 3)
-        elif bet_type.startswith("columna"):
-            if result != 0:
-                col = ((result - 1) % 3) + 1
-                if bet_type == f"columna{col}":
-                    win = amount * 3
-
-        # Split/Street/Corner/Line (usando '-' y tamaño de lista)
-        elif "-" in bet_type:
-            try:
-                nums = [int(n) for n in bet_type.split("-") if n.isdigit()]
-                if result in nums:
-                    if len(nums) == 2:
-                        win = amount * 18   # split -> 17:1 => 18x
-                    elif len(nums) == 3:
-                        win = amount * 12   # street -> 11:1 => 12x
-                    elif len(nums) == 4:
-                        win = amount * 9    # corner -> 8:1 => 9x
-                    elif len(nums) == 6:
-                        win = amount * 6    # line -> 5:1 => 6x
-            except Exception:
-                pass
-
-        # Número straight (single) -> 35:1 => 36x
-        else:
-            try:
-                if bet_type.isdigit() and int(bet_type) == result:
-                    win = amount * 36
-            except Exception:
-                pass
-
-        if win > 0:
-            db.add_balance(user_id, win)
-            winners.append((user_id, win))
+    async with chat_lanes.lane(chat_id):
+        # Las apuestas de la ronda tienen que estar en la BD antes de liquidarla
+        await ledger.flush()
+        # Cierra, paga, abre la siguiente ronda y guarda el próximo giro en una sola transacción
+        round_id, winners, open_rounds[chat_id] = await db.settle_round(
+            chat_id, result, scheduler.next_spin(chat_id))
+        board.new_round(chat_id, open_rounds[chat_id])
+        bets = round_bets.pop(chat_id, 0)
+        if not round_id:
+            return
+        metrics.observe("bets_per_round", bets, buckets=COUNT_BUCKETS)
+        for user_id, prize in winners:
+            # Los premios ya están confirmados en la BD: sólo se reflejan en memoria
+            ledger.apply_committed(user_id, prize)
+            leaderboards.record_win(chat_id, user_id, prize)
 
     sym, color_name = get_color_and_symbol(result)
 
@@ -369,12 +573,8 @@ async def spin_and_settle(context: ContextTypes.DEFAULT_TYPE):
     if winners:
         total_paid = sum(p for _, p in winners)
         top_uid, top_prize = max(winners, key=lambda x: x[1])
-        # Obtener nombre legible
-        try:
-            member = await context.bot.get_chat_member(chat_id, top_uid)
-            winner_name = member.user.first_name or getattr(member.user, "username", None) or f"Jugador-{top_uid}"
-        except Exception:
-            winner_name = db.get_username(top_uid) or f"Jugador-{top_uid}"
+        # Nombre legible desde el directorio (sin llamadas a la API)
+        winner_name = await directory.name(top_uid) or f"Jugador-{top_uid}"
 
         banner = (
             "🎉🎊 <b>¡GANADOR!</b> 🎊🎉\n"
@@ -392,99 +592,390 @@ async def spin_and_settle(context: ContextTypes.DEFAULT_TYPE):
     else:
         text = f"🎡 Resultado: <u>{result} {sym} {color_name}</u>\n\n😢 No hubo ganadores."
 
-    # Abrimos nueva ronda para que la gente apueste mientras corre el job
-    db.get_or_open_round(chat_id)
-
-    # Enviar (HTML safe)
-    try:
-        await context.bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
-    except Exception as e:
-        logger.exception("Error enviando resultado")
+    # Enviar (HTML safe); los resultados tienen prioridad en la cola de salida
+    outbox.send(chat_id, text, priority=RESULT, parse_mode=ParseMode.HTML)
 
 
 # -------------------------
 # Control ruleta (admins)
 # -------------------------
+@chat_lanes.serialized
 async def ruleta_on(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db.init_db()
+    """/ruleta_on [segundos]: activa la mesa del grupo o cambia su intervalo."""
     if not await es_admin(update, context):
-        await update.message.reply_text("⛔ Solo admins pueden activar la ruleta.")
+        reply(update, "⛔ Solo admins pueden activar la ruleta.")
         return
 
     chat = update.effective_chat
-    try:
-        existing = context.job_queue.get_jobs_by_name(f'ruleta:{chat.id}')
-    except Exception:
-        existing = []
-    if existing:
-        await update.message.reply_text("⚠️ La ruleta ya está activa en este grupo.")
+    interval = ROUND_INTERVAL_SECONDS
+    if context.args:
+        try:
+            interval = int(context.args[0])
+            if not MIN_ROUND_INTERVAL_SECONDS <= interval <= MAX_ROUND_INTERVAL_SECONDS:
+                raise ValueError()
+        except ValueError:
+            reply(update, f"Uso: /ruleta_on [segundos] — entre {MIN_ROUND_INTERVAL_SECONDS} "
+                          f"y {MAX_ROUND_INTERVAL_SECONDS}.")
+            return
+    elif scheduler.is_active(chat.id):
+        reply(update, "⚠️ La ruleta ya está activa en este grupo.")
         return
 
-    db.get_or_open_round(chat.id)
-    context.job_queue.run_repeating(
-        spin_and_settle,
-        interval=ROUND_INTERVAL_SECONDS,
-        first=ROUND_INTERVAL_SECONDS,
-        chat_id=chat.id,
-        name=f'ruleta:{chat.id}',
-    )
-    await update.message.reply_text(f"✅ Ruleta activada. Gira cada {ROUND_INTERVAL_SECONDS} segundos.")
+    first = scheduler.add(chat.id, interval)
+    # Mesa, próximo giro y ronda abierta en la BD: sobreviven a un reinicio
+    open_rounds[chat.id] = await db.activate_table(chat.id, interval, first)
+    if BOARD_ENABLED:
+        board.open(chat.id, open_rounds[chat.id])
+    reply(update, f"✅ Ruleta activada. Gira cada {interval} segundos.")
 
 
+@chat_lanes.serialized
 async def ruleta_off(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await es_admin(update, context):
-        await update.message.reply_text("⛔ Solo admins pueden desactivar la ruleta.")
+        reply(update, "⛔ Solo admins pueden desactivar la ruleta.")
         return
     chat = update.effective_chat
-    jobs = context.job_queue.get_jobs_by_name(f'ruleta:{chat.id}')
-    if not jobs:
-        await update.message.reply_text("ℹ️ No hay ruleta activa.")
+    if not scheduler.remove(chat.id):
+        reply(update, "ℹ️ No hay ruleta activa.")
         return
-    for job in jobs:
-        job.schedule_removal()
-    await update.message.reply_text("⏹️ Ruleta desactivada.")
+    await db.deactivate_table(chat.id)
+    board.close(chat.id)
+    reply(update, "⏹️ Ruleta desactivada.")
 
 
 # -------------------------
 # Ranking
 # -------------------------
 async def ranking(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db.init_db()
-    rows = db.top_users(10)
+    """/ranking [grupo|hoy|semana]: top global por saldo, del grupo o mayores ganadores."""
+    chat = update.effective_chat
+    in_group = chat.type in ("group", "supergroup")
+    scope = context.args[0].lower() if context.args else ""
+    if scope == "grupo":
+        if not in_group:
+            reply(update, "Este ranking sólo funciona en grupos.")
+            return
+        rows = leaderboards.top_chat(chat.id, 10)
+        title, unit = "Top jugadores del grupo", "fichas"
+    elif scope in PERIODS:
+        rows = leaderboards.top_window(scope, chat.id if in_group else None, 10)
+        title, unit = f"Mayores ganadores ({scope})", "fichas ganadas"
+    else:
+        rows = leaderboards.top(10)
+        title, unit = "Top jugadores", "fichas"
+
     if not rows:
-        await update.message.reply_text("Aún no hay usuarios en el ranking.")
+        reply(update, "Aún no hay usuarios en el ranking.")
         return
-    text = ["🏆 <b>Top jugadores</b>:"]
+    text = [f"🏆 <b>{title}</b>:"]
     medals = ["🥇", "🥈", "🥉"] + ["🎖️"] * 7
-    for i, r in enumerate(rows, start=1):
-        name = r["username"] or f"Jugador-{r['user_id']}"
-        text.append(f"{medals[i-1]} {i}. {name} — {r['balance']} fichas")
-    await update.message.reply_text("\n".join(text), parse_mode=ParseMode.HTML)
+    for i, (user_id, score) in enumerate(rows, start=1):
+        name = await directory.name(user_id) or f"Jugador-{user_id}"
+        text.append(f"{medals[i-1]} {i}. {name} — {score} {unit}")
+    reply(update, "\n".join(text), parse_mode=ParseMode.HTML)
+
+
+# -------------------------
+# Historial y estadísticas del grupo
+# -------------------------
+async def historial(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/historial [n]: últimos n resultados del grupo (contadores de chat_stats, sin recorrer rounds)."""
+    chat = update.effective_chat
+    if chat.type not in ("group", "supergroup"):
+        reply(update, "Este comando sólo funciona en grupos.")
+        return
+    limit = 20
+    if context.args:
+        try:
+            limit = int(context.args[0])
+            if not 1 <= limit <= HISTORY_SIZE:
+                raise ValueError()
+        except ValueError:
+            reply(update, f"Uso: /historial [n] — entre 1 y {HISTORY_SIZE}.")
+            return
+    stats = await db.get_chat_stats(chat.id)
+    if not stats.spins:
+        reply(update, "Aún no ha girado la ruleta en este grupo.")
+        return
+    results = stats.history(limit)
+    numbers = " ".join(f"{n}{get_color_and_symbol(n)[0]}" for n in results)
+    reply(update, f"📜 <b>Últimos {len(results)} resultados</b> (el más reciente primero):\n{numbers}",
+          parse_mode=ParseMode.HTML)
+
+
+async def estadisticas(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/estadisticas: números calientes y fríos, reparto por color y rachas del grupo."""
+    chat = update.effective_chat
+    if chat.type not in ("group", "supergroup"):
+        reply(update, "Este comando sólo funciona en grupos.")
+        return
+    stats = await db.get_chat_stats(chat.id)
+    if not stats.spins:
+        reply(update, "Aún no ha girado la ruleta en este grupo.")
+        return
+
+    def numbers(ns):
+        return " · ".join(f"{n}{get_color_and_symbol(n)[0]} ({stats.counts[n]})" for n in ns)
+
+    colors = stats.by_color()
+    last = stats.last()
+    sym, color_name = get_color_and_symbol(last)
+    if last == 0:
+        parity = "el cero corta la racha de paridad"
+    else:
+        parity = f"{stats.parity_streak} {'par' if last % 2 == 0 else 'impar'}"
+    text = [
+        f"📊 <b>Estadísticas del grupo</b> — {stats.spins} tiradas",
+        f"🔥 Calientes: {numbers(stats.hot())}",
+        f"🧊 Fríos: {numbers(stats.cold())}",
+        f"♦️ Rojo {100 * colors[RED] / stats.spins:.1f}% · ♠️ Negro {100 * colors[BLACK] / stats.spins:.1f}% · "
+        f"🟢 Verde {100 * colors[GREEN] / stats.spins:.1f}%",
+        f"🔁 Racha actual: {stats.color_streak} {sym} {color_name} · {parity}",
+        f"🏅 Racha más larga: {stats.best_color_streak} del mismo color · "
+        f"{stats.best_parity_streak} de la misma paridad",
+    ]
+    reply(update, "\n".join(text), parse_mode=ParseMode.HTML)
+
+
+# -------------------------
+# Mantenimiento
+# -------------------------
+async def checkpoint_balances(context: ContextTypes.DEFAULT_TYPE):
+    """Concilia saldos con el historial de transacciones y avanza los checkpoints."""
+    for user_id, balance, expected in await db.reconcile():
+        logger.error("Saldo descuadrado: user_id=%s saldo=%s esperado=%s", user_id, balance, expected)
+    updated, skipped = await db.checkpoint()
+    logger.info("checkpoint: %d usuarios actualizados, %d descuadrados", updated, skipped)
+
+
+async def refresh_balances(context: ContextTypes.DEFAULT_TYPE):
+    """Modo shared: los saldos cambian también en otros shards; se releen para los rankings."""
+    for user_id, balance in await db.load_balances():
+        leaderboards.set_balance(user_id, balance)
+
+
+async def compact_history(context: ContextTypes.DEFAULT_TYPE):
+    """Archiva y resume las rondas más antiguas que RETENTION_DAYS."""
+    totals = await retention.compact(RETENTION_DAYS, ARCHIVE_DIR, COMPACTION_BATCH)
+    if totals["rounds"]:
+        logger.info("compactación: %s", totals)
+
+
+# -------------------------
+# Métricas
+# -------------------------
+def observe_db(name: str, queued: float, elapsed: float, wrote: bool):
+    metrics.observe("db_seconds", elapsed, fn=name)
+    metrics.observe("db_queue_seconds", queued, fn=name)
+    if wrote:
+        metrics.inc("db_commits_total", fn=name)
+
+
+def metrics_route(query: dict):
+    return "text/plain; version=0.0.4", metrics.render()
+
+
+def profile_route(query: dict):
+    """GET /profile?handler=apostar&rate=0.05 activa el perfilado; sin handler lo desactiva."""
+    try:
+        rate = float(query.get("rate", PROFILE_RATE))
+    except ValueError:
+        return "text/plain", "rate no válido\n"
+    metrics.profile(query.get("handler"), rate)
+    return "text/plain", f"profile handler={metrics.profile_handler} rate={metrics.profile_rate}\n"
+
+
+db.observer = observe_db
+for _name, _component in (("outbox", outbox), ("scheduler", scheduler), ("ledger", ledger),
+                          ("throttle", throttle), ("board", board), ("admin_cache", admin_cache),
+                          ("directory", directory)):
+    metrics.collect(_name, _component.stats)
+# Sólo en local: /profile cambia el comportamiento del bot
+metrics_server = WebhookServer(None, routes={"/metrics": metrics_route, "/profile": profile_route})
 
 
 # -------------------------
 # Main
 # -------------------------
+def owns_chat(chat_id: int) -> bool:
+    """En modo shard cada proceso sólo lleva los chats con chat_id % SHARD_COUNT == SHARD_INDEX."""
+    return chat_id % SHARD_COUNT == SHARD_INDEX
+
+
+async def restore_tables():
+    """
+    Arranque en caliente: vuelve a armar las mesas guardadas (sólo las de este
+    shard) y devuelve lo apostado en rondas abiertas de chats sin mesa activa.
+    Dos consultas y una transacción, sin importar cuántos grupos haya.
+    """
+    started = time.perf_counter()
+    tables, orphans = await db.load_tables()
+    tables = [table for table in tables if owns_chat(table[0])]
+    orphans = [round_id for round_id, chat_id in orphans if owns_chat(chat_id)]
+    refunds = await db.refund_rounds(orphans) if orphans else []
+    for user_id, amount in refunds:
+        # Ya confirmado en la BD: sólo se refleja en memoria
+        ledger.apply_committed(user_id, amount)
+    for chat_id, interval, next_spin_at, round_id, message_id in tables:
+        open_rounds[chat_id] = round_id
+        if BOARD_ENABLED and message_id:
+            board.restore(chat_id, round_id, message_id)
+    overdue = scheduler.restore([(chat_id, interval, next_spin_at) for chat_id, interval, next_spin_at, *_ in tables],
+                                spread=RESTART_SPREAD_SECONDS)
+    logger.info("Arranque en caliente: %d mesas (%d atrasadas), %d rondas huérfanas devueltas a %d usuarios "
+                "en %.2fs", len(tables), overdue, len(orphans), len(refunds), time.perf_counter() - started)
+
+
+async def post_init(app: Application):
+    # Esquema, índices y pragmas: una sola vez al arrancar
+    await db.migrate()
+    # Reproduce el diario que no llegó a volcarse antes de leer saldos
+    await ledger.open()
+    leaderboards.load(*await db.load_leaderboards(week_start(datetime.date.today())))
+    outbox.start(app.bot)
+    board.start(app.bot)
+    await restore_tables()
+    scheduler.start(spin_and_settle)
+    if SHARD_INDEX == 0:
+        # Mantenimiento de toda la BD: sólo en un shard
+        app.job_queue.run_repeating(checkpoint_balances, CHECKPOINT_INTERVAL_SECONDS,
+                                    first=CHECKPOINT_INTERVAL_SECONDS, name="checkpoint")
+        app.job_queue.run_repeating(compact_history, COMPACTION_INTERVAL_SECONDS, first=60, name="compaction")
+    if LEDGER_MODE == "shared":
+        app.job_queue.run_repeating(refresh_balances, LEADERBOARD_REFRESH_SECONDS,
+                                    first=LEADERBOARD_REFRESH_SECONDS, name="refresh-balances")
+    if METRICS_PORT:
+        # Un puerto por shard: METRICS_PORT, METRICS_PORT + 1, ...
+        await metrics_server.start(METRICS_LISTEN, METRICS_PORT + SHARD_INDEX)
+
+
+async def post_stop(app: Application):
+    await metrics_server.stop()
+    # Deja terminar los giros en curso antes de cerrar la BD y vacía la cola de salida
+    await scheduler.stop()
+    board.stop()
+    await outbox.stop()
+    # Último volcado: todo lo del diario queda en SQLite
+    await ledger.close()
+
+
+async def post_shutdown(app: Application):
+    if background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+    await db.close()
+    logger.info("admin_cache: %s", admin_cache.stats())
+    logger.info("directory: %s", directory.stats())
+    logger.info("scheduler: %s", scheduler.stats())
+    logger.info("outbox: %s", outbox.stats())
+    logger.info("ledger: %s", ledger.stats())
+    logger.info("board: %s", board.stats())
+    logger.info("throttle: %s", throttle.stats())
+
+
+def health() -> dict:
+    """Estado para GET /health del modo webhook."""
+    return {
+        "tables": len(scheduler),
+        "scheduler": scheduler.stats(),
+        "outbox": outbox.stats(),
+        "ledger": ledger.stats(),
+        "throttle": throttle.stats(),
+    }
+
+
+def build_app(webhook: bool = False, request=None) -> Application:
+    """Crea la Application con todos los handlers. `request` permite inyectar un BaseRequest (pruebas)."""
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if request is not None:
+        builder = builder.request(request)
+    if webhook:
+        # Los updates llegan por nuestro servidor HTTP: no hace falta Updater
+        builder = builder.updater(None)
+    app = builder.build()
+
+    app.add_handler(TypeHandler(Update, limitar), group=-1)
+    commands = {
+        "start": start,
+        "saldo": saldo,
+        "reglas": reglas,
+        "apostar": apostar,
+        "ruleta_on": ruleta_on,
+        "ruleta_off": ruleta_off,
+        "dar": dar,
+        "regalar": regalar,
+        "listar_admins": listar_admins,
+        "ranking": ranking,
+        "historial": historial,
+        "estadisticas": estadisticas,
+    }
+    for name, handler in commands.items():
+        app.add_handler(CommandHandler(name, metrics.timed(name, handler)))
+    app.add_handler(CallbackQueryHandler(metrics.timed("tablero", tablero), pattern=CALLBACK_PATTERN))
+    app.add_handler(ChatMemberHandler(on_chat_member, ChatMemberHandler.ANY_CHAT_MEMBER))
+    return app
+
+
+async def run_webhook(app: Application, stop_event: asyncio.Event = None):
+    """
+    Modo webhook: nuestro servidor HTTP recibe los Updates y los deja en la
+    update_queue de la Application, que los procesa con concurrent_updates.
+    Si WEBHOOK_URL está vacío no se registra el webhook en Telegram (útil para
+    probar en local reenviando Updates grabados con `python webhook.py`).
+    """
+    stop_event = stop_event or asyncio.Event()
+
+    async def handle_update(data: dict):
+        await app.update_queue.put(Update.de_json(data, app.bot))
+
+    secret = resolve_secret(WEBHOOK_SECRET, WEBHOOK_URL)
+    server = WebhookServer(handle_update, path=WEBHOOK_PATH, secret=secret,
+                           health=health, max_connections=WEBHOOK_MAX_CONNECTIONS)
+    await app.initialize()
+    await post_init(app)
+    await app.start()
+    await server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+    if WEBHOOK_URL:
+        await app.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=secret,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:  # Windows
+            pass
+    try:
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        await app.stop()
+        await post_stop(app)
+        await app.shutdown()
+        await post_shutdown(app)
+
+
 def main():
-    db.init_db()
     if not TOKEN:
         raise SystemExit("Falta BOT_TOKEN en .env")
-    app = Application.builder().token(TOKEN).build()
-    # Asegurar JobQueue inicializado
-    _ = app.job_queue
-
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("saldo", saldo))
-    app.add_handler(CommandHandler("reglas", reglas))
-    app.add_handler(CommandHandler("apostar", apostar))
-    app.add_handler(CommandHandler("ruleta_on", ruleta_on))
-    app.add_handler(CommandHandler("ruleta_off", ruleta_off))
-    app.add_handler(CommandHandler("dar", dar))
-    app.add_handler(CommandHandler("regalar", regalar))
-    app.add_handler(CommandHandler("listar_admins", listar_admins))
-    app.add_handler(CommandHandler("ranking", ranking))
-
-    app.run_polling()
+    if BOT_MODE == "webhook":
+        try:
+            asyncio.run(run_webhook(build_app(webhook=True)))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    # chat_member no llega por defecto: hay que pedirlo explícitamente
+    build_app().run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,102 @@
+import struct
+
+import roulette
+
+# Resultados recientes que se guardan por grupo (anillo de un byte por tirada)
+HISTORY_SIZE = 100
+# Veces que salió cada número: 37 enteros de 32 bits
+_COUNTS = struct.Struct(f"<{len(roulette.NUMBERS)}I")
+
+GREEN, RED, BLACK = 0, 1, 2
+
+
+def color(number: int) -> int:
+    if number == 0:
+        return GREEN
+    return RED if roulette.is_red(number) else BLACK
+
+
+class ChatStats:
+    """
+    Contadores de un grupo para /historial y /estadisticas, con tamaño fijo
+    (unos 250 bytes) sea cual sea el historial:
+      - frecuencia de cada número,
+      - anillo con los últimos HISTORY_SIZE resultados,
+      - racha actual y más larga del mismo color y de la misma paridad
+        (el cero corta la de paridad).
+    record() los actualiza en O(1); settle_round lo llama dentro de la
+    transacción que liquida la ronda, así que nunca se desvían de `rounds`.
+    """
+
+    __slots__ = ("spins", "counts", "recent", "color_streak", "parity_streak",
+                 "best_color_streak", "best_parity_streak")
+
+    def __init__(self):
+        self.spins = 0
+        self.counts = [0] * len(roulette.NUMBERS)
+        self.recent = bytearray(HISTORY_SIZE)
+        self.color_streak = 0
+        self.parity_streak = 0
+        self.best_color_streak = 0
+        self.best_parity_streak = 0
+
+    # ---- fila de chat_stats ----
+    @classmethod
+    def from_row(cls, row):
+        """(spins, counts, recent, color_streak, parity_streak, best_color_streak, best_parity_streak)"""
+        stats = cls()
+        if row is None:
+            return stats
+        spins, counts, recent, *streaks = row
+        stats.spins = spins
+        stats.counts = list(_COUNTS.unpack(bytes(counts)))
+        stats.recent[:] = bytes(recent)
+        (stats.color_streak, stats.parity_streak,
+         stats.best_color_streak, stats.best_parity_streak) = streaks
+        return stats
+
+    def to_row(self):
+        return (self.spins, _COUNTS.pack(*self.counts), bytes(self.recent), self.color_streak,
+                self.parity_streak, self.best_color_streak, self.best_parity_streak)
+
+    # ---- actualización ----
+    def record(self, result: int):
+        last = self.last()
+        self.counts[result] += 1
+        self.recent[self.spins % HISTORY_SIZE] = result
+        self.spins += 1
+        if last is not None and color(last) == color(result):
+            self.color_streak += 1
+        else:
+            self.color_streak = 1
+        if result == 0:
+            self.parity_streak = 0
+        elif last and last % 2 == result % 2:
+            self.parity_streak += 1
+        else:
+            self.parity_streak = 1
+        self.best_color_streak = max(self.best_color_streak, self.color_streak)
+        self.best_parity_streak = max(self.best_parity_streak, self.parity_streak)
+
+    # ---- consultas ----
+    def last(self):
+        return self.recent[(self.spins - 1) % HISTORY_SIZE] if self.spins else None
+
+    def history(self, limit: int = HISTORY_SIZE):
+        """Últimos resultados, del más reciente al más antiguo."""
+        limit = min(limit, self.spins, HISTORY_SIZE)
+        return [self.recent[(self.spins - 1 - i) % HISTORY_SIZE] for i in range(limit)]
+
+    def hot(self, limit: int = 5):
+        """Números que más han salido (a igualdad, el menor primero); sólo los que han salido."""
+        return [n for n in sorted(roulette.NUMBERS, key=lambda n: (-self.counts[n], n))[:limit] if self.counts[n]]
+
+    def cold(self, limit: int = 5):
+        """Números que menos han salido (a igualdad, el menor primero)."""
+        return sorted(roulette.NUMBERS, key=lambda n: (self.counts[n], n))[:limit]
+
+    def by_color(self) -> dict:
+        totals = {GREEN: 0, RED: 0, BLACK: 0}
+        for number, hits in enumerate(self.counts):
+            totals[color(number)] += hits
+        return totals
@@ -1,17 +1,104 @@
-import sqlite3
+import asyncio
+import datetime
+import functools
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-DB_FILE = Path("casino.db")
+import roulette
+import storage
+from chatstats import ChatStats
+
+# Con STORAGE_BACKEND=sqlite es la BD; con todos los motores, el prefijo del diario de ledger.py
+DB_FILE = Path(os.getenv("DB_PATH", "casino.db"))
 DEFAULT_START_BALANCE = 1000
+# Mayor cantidad por operación y mayor saldo: muy por debajo de 2**63 - 1
+# (INTEGER/BIGINT), así que saldo + premio (x36) nunca desborda la columna
+MAX_CHIPS = 10**15
+
+# El motor (storage.py) se elige con STORAGE_BACKEND la primera vez que se usa.
+# Todas las funciones públicas son corrutinas: el trabajo con la BD se hace en
+# los hilos de la BD (uno con SQLite, uno por conexión del pool con PostgreSQL)
+# y el event loop del bot nunca espera al disco ni a la red.
+# Con varios procesos (shard.py) cada uno tiene su conexión: las escrituras
+# empiezan por la sentencia que escribe o con begin_write() si antes leen,
+# así que esperan al lock en vez de fallar con SQLITE_BUSY.
+_storage = None
+_executor = None
+_local = threading.local()   # conexión del hilo durante una llamada
+# callback(nombre, segundos_en_cola, segundos_ejecutando, escribió) tras cada
+# llamada, en el event loop; lo usa metrics.py
+observer = None
+
+
+def configure(backend=None):
+    """Fija el motor (por defecto storage.from_env()). Antes de la primera llamada a la BD."""
+    global _storage, _executor
+    _storage = backend or storage.from_env()
+    _executor = ThreadPoolExecutor(max_workers=_storage.threads, thread_name_prefix="db")
+    return _storage
+
+
+def data_errors() -> tuple:
+    """Excepciones que dependen de los datos y no del momento: repetir la llamada volvería a fallar."""
+    if _storage is None:
+        configure()
+    return (OverflowError, ValueError, TypeError, KeyError) + _storage.data_errors
+
 
 def get_conn():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Conexión de la llamada en curso (sólo desde un hilo de la BD)."""
+    return _local.conn
 
-def init_db():
-    conn = get_conn()
-    c = conn.cursor()
+
+def _run_in_db_thread(fn):
+    """Ejecuta fn en un hilo de la BD con una conexión del motor; si falla, deshace la transacción abierta."""
+    def call(timing, *args, **kwargs):
+        timing.append(time.perf_counter())
+        conn = _local.conn = _storage.acquire()
+        changes = conn.total_changes
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            timing.append(time.perf_counter())
+            timing.append(conn.total_changes != changes)
+            _local.conn = None
+            _storage.release(conn)
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        if _executor is None:
+            configure()
+        timing = [time.perf_counter()]
+        try:
+            return await loop.run_in_executor(_executor, functools.partial(call, timing, *args, **kwargs))
+        finally:
+            if observer is not None and len(timing) == 4:
+                queued, started, finished, wrote = timing
+                observer(fn.__name__, started - queued, finished - started, wrote)
+    return wrapper
+
+
+async def close():
+    """Cierra las conexiones del motor tras lo que quede en cola."""
+    if _executor is not None:
+        await asyncio.get_running_loop().run_in_executor(_executor, _storage.close)
+
+# -------------------------
+# Migraciones
+# -------------------------
+# Cada migración recibe un cursor y se aplica una sola vez, dentro de su propia
+# transacción (ver storage.SQLiteStorage.migrate). PostgreSQL tiene su propio
+# esquema por versión en storage.POSTGRES_MIGRATIONS: una migración nueva aquí
+# necesita también la suya allí.
+def _v1_base_schema(c):
     c.execute("""
     CREATE TABLE IF NOT EXISTS users (
         user_id INTEGER PRIMARY KEY,
@@ -37,104 +124,735 @@ def init_db():
         result TEXT
     )
     """)
-    conn.commit()
-    conn.close()
 
+
+def _v2_hot_path_indexes(c):
+    # get_bets(round_id)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_bets_round ON bets (round_id)")
+    # get_or_open_round / close_round: sólo hay unas pocas rondas abiertas
+    c.execute("CREATE INDEX IF NOT EXISTS idx_rounds_open ON rounds (chat_id) WHERE status='open'")
+    # top_users
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_balance ON users (balance DESC)")
+
+
+def _v3_compiled_bets(c):
+    # Apuesta compilada (roulette.compile_bet): máscara de números y multiplicador
+    c.execute("ALTER TABLE bets ADD COLUMN mask INTEGER NOT NULL DEFAULT 0")
+    c.execute("ALTER TABLE bets ADD COLUMN payout INTEGER NOT NULL DEFAULT 0")
+    tokens = [row[0] for row in c.execute("SELECT DISTINCT bet_type FROM bets").fetchall()]
+    for token in tokens:
+        try:
+            bet = roulette.compile_bet(token or "")
+        except ValueError:
+            continue  # tokens antiguos inválidos nunca pagaron: se quedan en 0
+        c.execute("UPDATE bets SET mask=?, payout=? WHERE bet_type=?", (bet.mask, bet.payout, token))
+
+
+def _v4_leaderboards(c):
+    # Quién apostó en cada grupo (ranking por grupo)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS chat_players (
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        PRIMARY KEY (chat_id, user_id)
+    ) WITHOUT ROWID
+    """)
+    c.execute("INSERT OR IGNORE INTO chat_players (chat_id, user_id) SELECT DISTINCT chat_id, user_id FROM bets")
+    # Ganancias por día, grupo y usuario (rankings de hoy / de la semana)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS winnings (
+        day TEXT NOT NULL,
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, chat_id, user_id)
+    ) WITHOUT ROWID
+    """)
+
+
+def _v5_ledger_meta(c):
+    # Último seq del diario del ledger ya aplicado (ver ledger.py)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """)
+    c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('ledger_seq', 0)")
+
+
+def _v6_transactions(c):
+    # Historial de cada movimiento de fichas; el saldo de un usuario es
+    # su checkpoint + SUM(amount) de sus transacciones posteriores
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS transactions (
+        id INTEGER PRIMARY KEY,
+        ts INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        counterparty INTEGER,
+        chat_id INTEGER,
+        round_id INTEGER,
+        amount INTEGER NOT NULL
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions (user_id, id)")
+    # Último checkpoint de cada usuario: su saldo tras la transacción txn_id
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS balance_checkpoints (
+        user_id INTEGER PRIMARY KEY,
+        txn_id INTEGER NOT NULL,
+        balance INTEGER NOT NULL,
+        ts INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """)
+    # Sin historial previo: los saldos actuales son el punto de partida
+    c.execute("INSERT OR IGNORE INTO balance_checkpoints (user_id, txn_id, balance, ts) "
+              "SELECT user_id, 0, COALESCE(balance, 0), ? FROM users", (int(time.time()),))
+
+
+def _v7_retention(c):
+    # Momento de la liquidación: decide cuándo se compacta la ronda.
+    # Las cerradas antes de esta versión cuentan como liquidadas ahora.
+    c.execute("ALTER TABLE rounds ADD COLUMN settled_at INTEGER")
+    c.execute("UPDATE rounds SET settled_at=? WHERE status='closed'", (int(time.time()),))
+    c.execute("CREATE INDEX IF NOT EXISTS idx_rounds_settled ON rounds (settled_at) WHERE status='closed'")
+    # Resumen por grupo y día de las rondas ya compactadas
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        day TEXT NOT NULL,
+        chat_id INTEGER NOT NULL,
+        rounds INTEGER NOT NULL DEFAULT 0,
+        wagered INTEGER NOT NULL DEFAULT 0,
+        paid INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, chat_id)
+    ) WITHOUT ROWID
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS daily_numbers (
+        day TEXT NOT NULL,
+        chat_id INTEGER NOT NULL,
+        number INTEGER NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, chat_id, number)
+    ) WITHOUT ROWID
+    """)
+
+
+def _v8_active_tables(c):
+    # Mesas activas y su próximo giro: sobreviven a un reinicio (arranque en caliente)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS active_tables (
+        chat_id INTEGER PRIMARY KEY,
+        spin_interval INTEGER NOT NULL,
+        next_spin_at REAL NOT NULL,
+        board_message_id INTEGER
+    )
+    """)
+
+
+def _v9_chat_stats(c):
+    # Contadores por grupo de /historial y /estadisticas (ver chatstats.py):
+    # una fila de tamaño fijo por grupo, sin recorrer rounds
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS chat_stats (
+        chat_id INTEGER PRIMARY KEY,
+        spins INTEGER NOT NULL,
+        counts BLOB NOT NULL,
+        recent BLOB NOT NULL,
+        color_streak INTEGER NOT NULL,
+        parity_streak INTEGER NOT NULL,
+        best_color_streak INTEGER NOT NULL,
+        best_parity_streak INTEGER NOT NULL
+    )
+    """)
+
+
+def _v10_compact_refunded(c):
+    # La compactación también se lleva las rondas devueltas ('refunded'): el
+    # índice parcial pasa a cubrir todo lo que no está abierto
+    c.execute("DROP INDEX IF EXISTS idx_rounds_settled")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_rounds_settled ON rounds (settled_at) WHERE status<>'open'")
+
+
+MIGRATIONS = [
+    _v1_base_schema,
+    _v2_hot_path_indexes,
+    _v3_compiled_bets,
+    _v4_leaderboards,
+    _v5_ledger_meta,
+    _v6_transactions,
+    _v7_retention,
+    _v8_active_tables,
+    _v9_chat_stats,
+    _v10_compact_refunded,
+]
+
+
+@_run_in_db_thread
+def migrate():
+    """Aplica las migraciones pendientes. Se llama una vez al arrancar el bot."""
+    _storage.migrate(get_conn(), MIGRATIONS)
+    return len(MIGRATIONS)
+
+
+# -------------------------
+# Transacciones
+# -------------------------
+TXN_OPEN = "open"          # alta con el saldo inicial
+TXN_BET = "bet"
+TXN_PAYOUT = "payout"
+TXN_GRANT = "grant"        # /dar
+TXN_TRANSFER = "transfer"  # /regalar: una fila por cada lado
+TXN_ADJUST = "adjust"      # set_balance
+TXN_REFUND = "refund"      # rondas huérfanas devueltas al arrancar
+
+
+def _record(c, rows):
+    """Inserta transacciones (ts, kind, user_id, counterparty, chat_id, round_id, amount)."""
+    c.executemany("INSERT INTO transactions (ts, kind, user_id, counterparty, chat_id, round_id, amount) "
+                  "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+def _create_user(c, user_id: int, username: str = "", start_balance: int = DEFAULT_START_BALANCE) -> bool:
+    """Crea el usuario si no existe, con su transacción de alta. Devuelve True si lo creó."""
+    c.execute("INSERT INTO users (user_id, username, balance) VALUES (?, ?, ?) ON CONFLICT DO NOTHING",
+              (user_id, username or "", start_balance))
+    if not c.rowcount:
+        return False
+    _record(c, [(int(time.time()), TXN_OPEN, user_id, None, None, None, start_balance)])
+    return True
+
+@_run_in_db_thread
 def ensure_user(user_id: int, username: str = "", start_balance: int = DEFAULT_START_BALANCE):
+    """
+    Crea el usuario si no existe y actualiza su nombre sólo si cambió.
+    Devuelve (nombre_guardado, creado).
+    """
     conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT user_id FROM users WHERE user_id=?", (user_id,))
-    if not c.fetchone():
-        c.execute("INSERT INTO users (user_id, username, balance) VALUES (?, ?, ?)",
-                  (user_id, username or "", start_balance))
-    else:
-        if username:
-            c.execute("UPDATE users SET username=? WHERE user_id=?", (username, user_id))
-    conn.commit()
-    conn.close()
+    c.execute("SELECT username FROM users WHERE user_id=?", (user_id,))
+    row = c.fetchone()
+    if not row:
+        _create_user(c, user_id, username, start_balance)
+        conn.commit()
+        return username or "", True
+    if username and username != row["username"]:
+        c.execute("UPDATE users SET username=? WHERE user_id=?", (username, user_id))
+        conn.commit()
+        return username, False
+    return row["username"] or "", False
 
+@_run_in_db_thread
 def get_balance(user_id: int) -> int:
     conn = get_conn()
     c = conn.cursor()
     c.execute("SELECT balance FROM users WHERE user_id=?", (user_id,))
     row = c.fetchone()
-    conn.close()
     return int(row["balance"]) if row else 0
 
+@_run_in_db_thread
 def set_balance(user_id: int, value: int):
     conn = get_conn()
     c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO users (user_id, username, balance) VALUES (?, ?, ?)",
-              (user_id, "", DEFAULT_START_BALANCE))
+    _create_user(c, user_id)
+    old = c.execute("SELECT balance FROM users WHERE user_id=?", (user_id,)).fetchone()["balance"]
     c.execute("UPDATE users SET balance=? WHERE user_id=?", (value, user_id))
+    if value != old:
+        _record(c, [(int(time.time()), TXN_ADJUST, user_id, None, None, None, value - old)])
     conn.commit()
-    conn.close()
 
+
+@_run_in_db_thread
 def add_balance(user_id: int, delta: int):
+    """Suma delta al saldo. Devuelve el saldo nuevo, o None si pasaría de MAX_CHIPS."""
     conn = get_conn()
     c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO users (user_id, username, balance) VALUES (?, ?, ?)",
-              (user_id, "", DEFAULT_START_BALANCE))
-    c.execute("UPDATE users SET balance = balance + ? WHERE user_id=?", (delta, user_id))
+    _create_user(c, user_id)
+    c.execute("UPDATE users SET balance = balance + ? WHERE user_id=? AND balance <= ? RETURNING balance",
+              (delta, user_id, MAX_CHIPS - delta))
+    row = c.fetchone()
+    if not row:
+        conn.rollback()
+        return None
+    balance = row["balance"]
+    _record(c, [(int(time.time()), TXN_GRANT, user_id, None, None, None, delta)])
     conn.commit()
-    conn.close()
+    return balance
 
-def place_bet(chat_id, round_id, user_id, bet_type, amount):
+@_run_in_db_thread
+def transfer(from_id: int, to_id: int, amount: int):
+    """
+    Mueve `amount` fichas de from_id a to_id en una transacción, con débito
+    condicional. Devuelve (saldo_origen, saldo_destino) o None si no alcanza
+    o si el destino pasaría de MAX_CHIPS.
+    """
     conn = get_conn()
     c = conn.cursor()
-    c.execute("INSERT INTO bets (chat_id, round_id, user_id, bet_type, amount) VALUES (?, ?, ?, ?, ?)",
-              (chat_id, round_id, user_id, bet_type, amount))
+    c.execute("UPDATE users SET balance = balance - ? WHERE user_id=? AND balance >= ? RETURNING balance",
+              (amount, from_id, amount))
+    debited = c.fetchone()
+    if not debited:
+        conn.rollback()
+        return None
+    _create_user(c, to_id)
+    c.execute("UPDATE users SET balance = balance + ? WHERE user_id=? AND balance <= ? RETURNING balance",
+              (amount, to_id, MAX_CHIPS - amount))
+    credited = c.fetchone()
+    if not credited:
+        conn.rollback()
+        return None
+    now = int(time.time())
+    _record(c, [(now, TXN_TRANSFER, from_id, to_id, None, None, -amount),
+                (now, TXN_TRANSFER, to_id, from_id, None, None, amount)])
     conn.commit()
-    conn.close()
+    from_balance = debited["balance"] + amount if from_id == to_id else debited["balance"]
+    return from_balance, credited["balance"]
+
+# Resultado estructurado de place_bet_atomic
+BET_ACCEPTED = "accepted"
+BET_INSUFFICIENT_FUNDS = "insufficient_funds"
+BET_ROUND_CLOSED = "round_closed"
+BetResult = namedtuple("BetResult", "status round_id balance")
 
-def get_or_open_round(chat_id):
+
+@_run_in_db_thread
+def place_bet_atomic(chat_id, user_id, bets) -> BetResult:
+    """
+    Resuelve la ronda abierta, descuenta el total sólo si alcanza y registra las
+    apuestas [(CompiledBet, cantidad), ...], todo en una transacción. Nunca deja
+    el saldo en negativo.
+    """
     conn = get_conn()
     c = conn.cursor()
     c.execute("SELECT id FROM rounds WHERE chat_id=? AND status='open'", (chat_id,))
     row = c.fetchone()
-    if row:
-        round_id = row[0]
-    else:
-        c.execute("INSERT INTO rounds (chat_id, status) VALUES (?, 'open')", (chat_id,))
-        round_id = c.lastrowid
+    if not row:
+        return BetResult(BET_ROUND_CLOSED, None, None)
+    round_id = row[0]
+    total = sum(amount for _, amount in bets)
+    c.execute("UPDATE users SET balance = balance - ? WHERE user_id=? AND balance >= ? RETURNING balance",
+              (total, user_id, total))
+    debited = c.fetchone()
+    if not debited:
+        conn.rollback()
+        return BetResult(BET_INSUFFICIENT_FUNDS, round_id, None)
+    c.executemany("INSERT INTO bets (chat_id, round_id, user_id, bet_type, amount, mask, payout) "
+                  "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                  [(chat_id, round_id, user_id, bet.token, amount, bet.mask, bet.payout) for bet, amount in bets])
+    now = int(time.time())
+    _record(c, [(now, TXN_BET, user_id, None, chat_id, round_id, -amount) for _, amount in bets])
+    c.execute("INSERT INTO chat_players (chat_id, user_id) VALUES (?, ?) ON CONFLICT DO NOTHING", (chat_id, user_id))
     conn.commit()
-    conn.close()
-    return round_id
+    return BetResult(BET_ACCEPTED, round_id, debited["balance"])
 
-def close_round(chat_id, result):
+@_run_in_db_thread
+def settle_round(chat_id, result: int, next_spin_at: float = None):
+    """
+    Liquida la ronda abierta de chat_id en una sola transacción: la cierra con
+    su resultado, acredita las ganancias agregadas por usuario, las suma a las
+    ganancias del día, suma el resultado a las estadísticas del grupo, abre la
+    siguiente ronda y guarda el próximo giro de la mesa.
+    Devuelve (round_id, [(user_id, premio), ...], id_ronda_siguiente);
+    round_id es None si no había ronda abierta.
+    """
     conn = get_conn()
     c = conn.cursor()
     c.execute("SELECT id FROM rounds WHERE chat_id=? AND status='open'", (chat_id,))
     row = c.fetchone()
-    if not row:
-        conn.close()
-        return None
-    round_id = row[0]
-    c.execute("UPDATE rounds SET status='closed', result=? WHERE id=?", (result, round_id))
+    round_id = row[0] if row else None
+    winners = []
+    if round_id is not None:
+        c.execute("UPDATE rounds SET status='closed', result=?, settled_at=? WHERE id=?",
+                  (str(result), int(time.time()), round_id))
+        # Test de bit sobre la máscara compilada, sumado por usuario
+        prizes = """
+            SELECT user_id, SUM(amount * payout) AS prize FROM bets
+            WHERE round_id=? AND ((mask >> ?) & 1) = 1
+            GROUP BY user_id
+        """
+        c.execute(prizes, (round_id, result))
+        winners = [(row["user_id"], row["prize"]) for row in c.fetchall()]
+        if winners:
+            c.execute(f"""
+                UPDATE users SET balance = balance + w.prize
+                FROM ({prizes}) AS w
+                WHERE users.user_id = w.user_id
+            """, (round_id, result))
+            _record(c, [(int(time.time()), TXN_PAYOUT, user_id, None, chat_id, round_id, prize)
+                        for user_id, prize in winners])
+            c.executemany("""
+                INSERT INTO winnings (day, chat_id, user_id, amount) VALUES (?, ?, ?, ?)
+                ON CONFLICT (day, chat_id, user_id) DO UPDATE SET amount = winnings.amount + excluded.amount
+            """, [(datetime.date.today().isoformat(), chat_id, user_id, prize) for user_id, prize in winners])
+        _record_spin(c, chat_id, result)
+    c.execute("INSERT INTO rounds (chat_id, status) VALUES (?, 'open') RETURNING id", (chat_id,))
+    next_round_id = c.fetchone()[0]
+    if next_spin_at is not None:
+        c.execute("UPDATE active_tables SET next_spin_at=? WHERE chat_id=?", (next_spin_at, chat_id))
     conn.commit()
-    conn.close()
-    return round_id
+    return round_id, winners, next_round_id
 
+_STATS_COLUMNS = "spins, counts, recent, color_streak, parity_streak, best_color_streak, best_parity_streak"
+
+
+def _record_spin(c, chat_id: int, result: int):
+    """Lee, actualiza y guarda la fila de chat_stats del grupo: coste fijo, sin mirar rounds."""
+    c.execute(f"SELECT {_STATS_COLUMNS} FROM chat_stats WHERE chat_id=?", (chat_id,))
+    stats = ChatStats.from_row(c.fetchone())
+    stats.record(result)
+    c.execute(f"""
+        INSERT INTO chat_stats (chat_id, {_STATS_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (chat_id) DO UPDATE SET
+            spins = excluded.spins, counts = excluded.counts, recent = excluded.recent,
+            color_streak = excluded.color_streak, parity_streak = excluded.parity_streak,
+            best_color_streak = excluded.best_color_streak, best_parity_streak = excluded.best_parity_streak
+    """, (chat_id, *stats.to_row()))
+
+
+@_run_in_db_thread
+def get_chat_stats(chat_id: int):
+    """ChatStats del grupo (vacío si aún no ha girado)."""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute(f"SELECT {_STATS_COLUMNS} FROM chat_stats WHERE chat_id=?", (chat_id,))
+    return ChatStats.from_row(c.fetchone())
+
+@_run_in_db_thread
 def get_bets(round_id):
     conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT user_id, bet_type, amount FROM bets WHERE round_id=?", (round_id,))
+    c.execute("SELECT user_id, amount, mask, payout FROM bets WHERE round_id=?", (round_id,))
     rows = c.fetchall()
-    conn.close()
     return rows
 
+@_run_in_db_thread
 def top_users(limit: int = 10):
     conn = get_conn()
     c = conn.cursor()
     c.execute("SELECT user_id, username, balance FROM users ORDER BY balance DESC LIMIT ?", (limit,))
     rows = c.fetchall()
-    conn.close()
     return rows
 
+@_run_in_db_thread
 def get_username(user_id: int):
     conn = get_conn()
     c = conn.cursor()
     c.execute("SELECT username FROM users WHERE user_id=?", (user_id,))
     row = c.fetchone()
-    conn.close()
     return row["username"] if row and row["username"] else None
+
+
+@_run_in_db_thread
+def delete_user(user_id: int):
+    """Borra el usuario; devuelve su fila (user_id, username, balance) o None si no existía."""
+    conn = get_conn()
+    c = conn.cursor()
+    row = c.execute("DELETE FROM users WHERE user_id=? RETURNING user_id, username, balance", (user_id,)).fetchone()
+    conn.commit()
+    return tuple(row) if row else None
+
+
+@_run_in_db_thread
+def load_balances():
+    conn = get_conn()
+    c = conn.cursor()
+    return [(row["user_id"], row["balance"]) for row in c.execute("SELECT user_id, balance FROM users")]
+
+
+@_run_in_db_thread
+def load_leaderboards(since: datetime.date):
+    """Datos para Leaderboards.load(): saldos, jugadores por grupo y ganancias desde `since`."""
+    conn = get_conn()
+    c = conn.cursor()
+    balances = c.execute("SELECT user_id, balance FROM users").fetchall()
+    memberships = c.execute("""
+        SELECT p.chat_id, p.user_id, u.balance
+        FROM chat_players p JOIN users u ON u.user_id = p.user_id
+    """).fetchall()
+    winnings = c.execute("SELECT day, chat_id, user_id, amount FROM winnings WHERE day >= ?",
+                         (since.isoformat(),)).fetchall()
+    return balances, memberships, winnings
+
+
+# -------------------------
+# Mesas activas (arranque en caliente)
+# -------------------------
+
+@_run_in_db_thread
+def activate_table(chat_id: int, interval: int, next_spin_at: float) -> int:
+    """Guarda la mesa (o su nuevo intervalo) y abre su ronda si no hay una. Devuelve la ronda abierta."""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("""
+        INSERT INTO active_tables (chat_id, spin_interval, next_spin_at) VALUES (?, ?, ?)
+        ON CONFLICT (chat_id) DO UPDATE SET
+            spin_interval = excluded.spin_interval, next_spin_at = excluded.next_spin_at
+    """, (chat_id, interval, next_spin_at))
+    row = c.execute("SELECT id FROM rounds WHERE chat_id=? AND status='open'", (chat_id,)).fetchone()
+    if row:
+        round_id = row[0]
+    else:
+        c.execute("INSERT INTO rounds (chat_id, status) VALUES (?, 'open') RETURNING id", (chat_id,))
+        round_id = c.fetchone()[0]
+    conn.commit()
+    return round_id
+
+
+@_run_in_db_thread
+def deactivate_table(chat_id: int):
+    """La ronda abierta se queda: se liquida si la mesa vuelve o se devuelve al arrancar."""
+    conn = get_conn()
+    conn.execute("DELETE FROM active_tables WHERE chat_id=?", (chat_id,))
+    conn.commit()
+
+
+@_run_in_db_thread
+def set_board_message(chat_id: int, message_id: int):
+    conn = get_conn()
+    conn.execute("UPDATE active_tables SET board_message_id=? WHERE chat_id=?", (message_id, chat_id))
+    conn.commit()
+
+
+@_run_in_db_thread
+def load_tables():
+    """
+    Todo lo que necesita el arranque en caliente, en una lectura:
+    mesas activas [(chat_id, intervalo, próximo_giro, ronda_abierta, mensaje_tablero), ...]
+    y rondas abiertas de chats sin mesa [(round_id, chat_id), ...].
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    tables = c.execute("""
+        SELECT t.chat_id, t.spin_interval, t.next_spin_at, r.id AS round_id, t.board_message_id
+        FROM active_tables t LEFT JOIN rounds r ON r.chat_id = t.chat_id AND r.status = 'open'
+    """).fetchall()
+    orphans = c.execute("""
+        SELECT r.id, r.chat_id FROM rounds r
+        WHERE r.status = 'open' AND NOT EXISTS (SELECT 1 FROM active_tables t WHERE t.chat_id = r.chat_id)
+    """).fetchall()
+    return [tuple(row) for row in tables], [tuple(row) for row in orphans]
+
+
+@_run_in_db_thread
+def refund_rounds(round_ids):
+    """
+    Devuelve lo apostado en las rondas abiertas `round_ids` y las marca como
+    'refunded', en una transacción. Devuelve [(user_id, devuelto), ...].
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    _storage.begin_write(c)
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS refund_ids (id INTEGER PRIMARY KEY)")
+    c.execute("DELETE FROM refund_ids")
+    c.executemany("INSERT INTO refund_ids (id) VALUES (?)", [(i,) for i in round_ids])
+    # Sólo las que siguen abiertas: otro proceso pudo liquidarlas o devolverlas antes
+    refunds = c.execute("""
+        SELECT b.round_id, b.chat_id, b.user_id, SUM(b.amount) AS amount
+        FROM bets b JOIN rounds r ON r.id = b.round_id
+        WHERE r.id IN (SELECT id FROM refund_ids) AND r.status = 'open'
+        GROUP BY b.round_id, b.chat_id, b.user_id
+    """).fetchall()
+    c.execute("UPDATE rounds SET status='refunded', settled_at=? "
+              "WHERE id IN (SELECT id FROM refund_ids) AND status='open'", (int(time.time()),))
+    totals = {}
+    for row in refunds:
+        totals[row["user_id"]] = totals.get(row["user_id"], 0) + row["amount"]
+    c.executemany("UPDATE users SET balance = balance + ? WHERE user_id=?",
+                  [(amount, user_id) for user_id, amount in totals.items()])
+    now = int(time.time())
+    _record(c, [(now, TXN_REFUND, row["user_id"], None, row["chat_id"], row["round_id"], row["amount"])
+                for row in refunds])
+    c.execute("DELETE FROM refund_ids")
+    conn.commit()
+    return list(totals.items())
+
+
+# -------------------------
+# Ledger (ver ledger.py)
+# -------------------------
+
+@_run_in_db_thread
+def load_ledger():
+    """Devuelve (último seq aplicado, {user_id: saldo})."""
+    conn = get_conn()
+    c = conn.cursor()
+    seq = c.execute("SELECT value FROM meta WHERE key='ledger_seq'").fetchone()[0]
+    balances = {row["user_id"]: row["balance"] for row in c.execute("SELECT user_id, balance FROM users")}
+    return seq, balances
+
+
+@_run_in_db_thread
+def apply_journal(entries):
+    """
+    Aplica en una transacción un lote de registros del diario del ledger:
+    inserta las apuestas y sus transacciones, suma los cambios de saldo
+    agregados por usuario y guarda el último seq. Los registros con seq ya aplicado se ignoran.
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    _storage.begin_write(c)
+    applied = c.execute("SELECT value FROM meta WHERE key='ledger_seq'").fetchone()[0]
+    entries = [e for e in entries if e["seq"] > applied]
+    if not entries:
+        conn.rollback()
+        return 0
+    deltas = {}
+    bets = []
+    txns = []
+    for e in entries:
+        deltas[e["user"]] = deltas.get(e["user"], 0) + e["amount"]
+        if e["kind"] == TXN_TRANSFER:
+            deltas[e["to"]] = deltas.get(e["to"], 0) - e["amount"]
+            txns.append((e["ts"], TXN_TRANSFER, e["user"], e["to"], None, None, e["amount"]))
+            txns.append((e["ts"], TXN_TRANSFER, e["to"], e["user"], None, None, -e["amount"]))
+        elif e["kind"] == TXN_BET:
+            # Diarios anteriores a las apuestas múltiples: una apuesta por registro
+            legs = e.get("bets") or [[e["token"], e["mask"], e["payout"], -e["amount"]]]
+            for token, mask, payout, amount in legs:
+                bets.append((e["chat"], e["round"], e["user"], token, amount, mask, payout))
+                txns.append((e["ts"], TXN_BET, e["user"], None, e["chat"], e["round"], -amount))
+        else:
+            txns.append((e["ts"], e["kind"], e["user"], None, None, None, e["amount"]))
+    for user_id in deltas:
+        _create_user(c, user_id)
+    c.executemany("UPDATE users SET balance = balance + ? WHERE user_id=?",
+                  [(delta, user_id) for user_id, delta in deltas.items() if delta])
+    _record(c, txns)
+    if bets:
+        c.executemany("INSERT INTO bets (chat_id, round_id, user_id, bet_type, amount, mask, payout) "
+                      "VALUES (?, ?, ?, ?, ?, ?, ?)", bets)
+        c.executemany("INSERT INTO chat_players (chat_id, user_id) VALUES (?, ?) ON CONFLICT DO NOTHING",
+                      {(b[0], b[2]) for b in bets})
+    c.execute("UPDATE meta SET value=? WHERE key='ledger_seq'", (max(e["seq"] for e in entries),))
+    conn.commit()
+    return len(entries)
+
+
+# -------------------------
+# Checkpoints y conciliación
+# -------------------------
+# Saldo esperado: checkpoint + transacciones posteriores (usa idx_transactions_user)
+_EXPECTED = """
+    SELECT u.user_id, u.balance,
+           COALESCE(k.balance, 0) + COALESCE((
+               SELECT SUM(t.amount) FROM transactions t
+               WHERE t.user_id = u.user_id AND t.id > COALESCE(k.txn_id, 0)
+           ), 0) AS expected
+    FROM users u LEFT JOIN balance_checkpoints k ON k.user_id = u.user_id
+"""
+
+
+@_run_in_db_thread
+def rebuild_balance(user_id: int):
+    """Saldo de user_id reconstruido desde su último checkpoint (None si no existe)."""
+    conn = get_conn()
+    c = conn.cursor()
+    row = c.execute(_EXPECTED + " WHERE u.user_id=?", (user_id,)).fetchone()
+    return row["expected"] if row else None
+
+
+@_run_in_db_thread
+def reconcile():
+    """Usuarios cuyo saldo no cuadra con el historial: [(user_id, saldo, esperado), ...]."""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute(f"SELECT * FROM ({_EXPECTED}) AS e WHERE balance IS NULL OR balance <> expected")
+    return [(row["user_id"], row["balance"], row["expected"]) for row in c.fetchall()]
+
+
+@_run_in_db_thread
+def checkpoint():
+    """
+    Nuevo checkpoint para cada usuario con transacciones desde el anterior y
+    cuyo saldo cuadra; los descuadrados conservan el suyo para seguir
+    detectándolos. Devuelve (usuarios actualizados, descuadrados).
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    _storage.begin_write(c)
+    last = c.execute("SELECT COALESCE(MAX(id), 0) FROM transactions").fetchone()[0]
+    c.execute(f"""
+        SELECT * FROM ({_EXPECTED}
+            WHERE EXISTS (SELECT 1 FROM transactions t
+                          WHERE t.user_id = u.user_id AND t.id > COALESCE(k.txn_id, 0))) AS e
+    """)
+    rows = c.fetchall()
+    ok = [(row["user_id"], last, row["balance"], int(time.time())) for row in rows
+          if row["balance"] == row["expected"]]
+    c.executemany("""
+        INSERT INTO balance_checkpoints (user_id, txn_id, balance, ts) VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET txn_id=excluded.txn_id, balance=excluded.balance, ts=excluded.ts
+    """, ok)
+    conn.commit()
+    return len(ok), len(rows) - len(ok)
+
+
+# -------------------------
+# Retención (ver retention.py)
+# -------------------------
+# Liquidadas ('closed') y devueltas ('refunded'): ambas tienen settled_at
+_SETTLED_BEFORE = "SELECT id FROM rounds WHERE status<>'open' AND settled_at < ? ORDER BY id LIMIT ?"
+
+
+@_run_in_db_thread
+def load_settled_rounds(before: int, limit: int):
+    """Hasta `limit` rondas liquidadas antes de `before` (epoch) y sus apuestas: (rondas, apuestas)."""
+    conn = get_conn()
+    c = conn.cursor()
+    rounds = c.execute(f"""
+        SELECT id, chat_id, status, result, settled_at, {_storage.day("settled_at")} AS day
+        FROM rounds WHERE id IN ({_SETTLED_BEFORE}) ORDER BY id
+    """, (before, limit)).fetchall()
+    bets = c.execute(f"SELECT * FROM bets WHERE round_id IN ({_SETTLED_BEFORE}) ORDER BY id",
+                     (before, limit)).fetchall()
+    return rounds, bets
+
+
+@_run_in_db_thread
+def compact_rounds(round_ids):
+    """
+    Suma las rondas `round_ids` (ya archivadas) a daily_stats y daily_numbers y
+    borra esas rondas y sus apuestas, en una transacción. Las devueltas no
+    cuentan en los resúmenes (no hubo giro), pero también se borran.
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    _storage.begin_write(c)
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS compact_ids (id INTEGER PRIMARY KEY)")
+    c.execute("DELETE FROM compact_ids")
+    c.executemany("INSERT INTO compact_ids (id) VALUES (?)", [(i,) for i in round_ids])
+    c.execute(f"""
+        INSERT INTO daily_stats (day, chat_id, rounds, wagered, paid)
+        SELECT day, chat_id, COUNT(*), SUM(wagered), SUM(paid) FROM (
+            SELECT {_storage.day("r.settled_at")} AS day, r.chat_id,
+                   (SELECT COALESCE(SUM(b.amount), 0) FROM bets b WHERE b.round_id = r.id) AS wagered,
+                   (SELECT COALESCE(SUM(b.amount * b.payout), 0) FROM bets b
+                    WHERE b.round_id = r.id AND ((b.mask >> CAST(r.result AS INTEGER)) & 1) = 1) AS paid
+            FROM rounds r WHERE r.id IN (SELECT id FROM compact_ids) AND r.status = 'closed'
+        ) AS s WHERE true GROUP BY day, chat_id
+        ON CONFLICT (day, chat_id) DO UPDATE SET
+            rounds = daily_stats.rounds + excluded.rounds,
+            wagered = daily_stats.wagered + excluded.wagered,
+            paid = daily_stats.paid + excluded.paid
+    """)
+    c.execute(f"""
+        INSERT INTO daily_numbers (day, chat_id, number, hits)
+        SELECT {_storage.day("settled_at")}, chat_id, CAST(result AS INTEGER), COUNT(*)
+        FROM rounds WHERE id IN (SELECT id FROM compact_ids) AND result IS NOT NULL
+        GROUP BY 1, 2, 3
+        ON CONFLICT (day, chat_id, number) DO UPDATE SET hits = daily_numbers.hits + excluded.hits
+    """)
+    c.execute("DELETE FROM bets WHERE round_id IN (SELECT id FROM compact_ids)")
+    deleted_bets = c.rowcount
+    c.execute("DELETE FROM rounds WHERE id IN (SELECT id FROM compact_ids)")
+    deleted_rounds = c.rowcount
+    c.execute("DELETE FROM compact_ids")
+    conn.commit()
+    return deleted_rounds, deleted_bets
+
+
+@_run_in_db_thread
+def incremental_vacuum(pages: int = 0):
+    """Devuelve al sistema páginas libres (todas si pages=0); el número de páginas liberadas."""
+    return _storage.vacuum(get_conn(), pages)
@@ -0,0 +1,42 @@
+import db
+from cache import TTLCache
+
+
+class UserDirectory:
+    """
+    Directorio en memoria user_id -> nombre visible. Estar en la caché significa
+    que el usuario ya existe en la BD, así que sólo se escribe cuando el usuario
+    es nuevo o cambió de nombre.
+    """
+
+    def __init__(self, maxsize: int = 100_000, on_new=None):
+        self._names = TTLCache(maxsize=maxsize, ttl=float("inf"))
+        self.on_new = on_new  # callback(user_id) cuando se da de alta un usuario
+        self.db_writes = 0
+
+    async def ensure(self, user_id: int, name: str = ""):
+        known = self._names.get(user_id)
+        if known is not None and (not name or name == known):
+            return
+        self.db_writes += 1
+        stored, created = await db.ensure_user(user_id, name)
+        self._names.set(user_id, stored)
+        if created and self.on_new:
+            self.on_new(user_id)
+
+    def cached(self, user_id: int):
+        """Nombre en caché (o None) sin tocar la BD."""
+        return self._names.get(user_id) or None
+
+    async def name(self, user_id: int):
+        """Nombre visible: de la caché o, si no está, de la BD (nunca de la API)."""
+        cached = self._names.get(user_id)
+        if cached is None:
+            cached = await db.get_username(user_id)
+            if cached is None:
+                return None
+            self._names.set(user_id, cached)
+        return cached or None
+
+    def stats(self) -> dict:
+        return dict(self._names.stats(), db_writes=self.db_writes)
@@ -0,0 +1,42 @@
+import asyncio
+import contextlib
+import functools
+
+
+class ChatLanes:
+    """
+    Un carril (asyncio.Lock) por chat. Dentro de un chat las rondas, apuestas y
+    liquidaciones se ejecutan de una en una; chats distintos corren en paralelo.
+    Los locks se crean al usarse y se descartan cuando nadie los espera.
+    """
+
+    def __init__(self):
+        self._locks = {}  # chat_id -> [Lock, usuarios]
+
+    @contextlib.asynccontextmanager
+    async def lane(self, chat_id: int):
+        entry = self._locks.get(chat_id)
+        if entry is None:
+            entry = self._locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[chat_id]
+
+    def serialized(self, handler):
+        """Decorador para handlers: ejecuta el update en el carril de su chat."""
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            chat = update.effective_chat
+            if chat is None:
+                return await handler(update, context)
+            async with self.lane(chat.id):
+                return await handler(update, context)
+        return wrapper
+
+    def __len__(self):
+        return len(self._locks)
@@ -0,0 +1,129 @@
+import bisect
+import datetime
+from collections import defaultdict
+
+# Ventanas de tiempo soportadas por /ranking hoy|semana
+PERIODS = ("hoy", "semana")
+
+
+def period_keys(day: datetime.date) -> dict:
+    """Clave de cada ventana para un día: la fecha y la semana ISO."""
+    year, week, _ = day.isocalendar()
+    return {"hoy": day.isoformat(), "semana": f"{year}-W{week:02d}"}
+
+
+def week_start(day: datetime.date) -> datetime.date:
+    return day - datetime.timedelta(days=day.weekday())
+
+
+class Leaderboard:
+    """
+    Ranking ordenado en memoria. Mantiene una lista ordenada de (-puntos, id):
+    top(k) sólo lee k entradas y cada actualización busca su sitio con bisect
+    (O(log n)), pero insertar y borrar en la lista desplaza lo que va detrás,
+    así que cuesta O(n) (un memmove: ~40 µs con 100 000 miembros, ~400 µs con
+    un millón).
+    """
+
+    def __init__(self):
+        self._scores = {}
+        self._order = []
+
+    def update(self, member, score: int):
+        old = self._scores.get(member)
+        if old == score:
+            return
+        if old is not None:
+            del self._order[bisect.bisect_left(self._order, (-old, member))]
+        self._scores[member] = score
+        bisect.insort(self._order, (-score, member))
+
+    def add(self, member, delta: int):
+        self.update(member, self._scores.get(member, 0) + delta)
+
+    def remove(self, member):
+        old = self._scores.pop(member, None)
+        if old is not None:
+            del self._order[bisect.bisect_left(self._order, (-old, member))]
+
+    def top(self, limit: int = 10):
+        return [(member, -score) for score, member in self._order[:limit]]
+
+    def __contains__(self, member):
+        return member in self._scores
+
+    def __len__(self):
+        return len(self._scores)
+
+
+class Leaderboards:
+    """
+    Todos los rankings del bot, actualizados en cuanto cambia un saldo:
+      - global por saldo,
+      - por grupo, con el saldo de quienes apostaron en ese grupo,
+      - mayores ganadores de hoy / de la semana, por grupo y global (chat None).
+    """
+
+    def __init__(self):
+        self.balances = Leaderboard()
+        self._chats = {}                   # chat_id -> Leaderboard
+        self._user_chats = defaultdict(set)  # user_id -> chats donde apostó
+        self._windows = {}                 # (periodo, chat_id) -> Leaderboard
+        self._current = {}                 # periodo -> clave vigente
+
+    # ---- saldos ----
+    def set_balance(self, user_id: int, balance: int):
+        self.balances.update(user_id, balance)
+        for chat_id in self._user_chats.get(user_id, ()):
+            self._chats[chat_id].update(user_id, balance)
+
+    def joined(self, chat_id: int, user_id: int, balance: int):
+        """El usuario apostó en chat_id: entra (o sigue) en el ranking del grupo."""
+        self._user_chats[user_id].add(chat_id)
+        self._chats.setdefault(chat_id, Leaderboard()).update(user_id, balance)
+
+    def top(self, limit: int = 10):
+        return self.balances.top(limit)
+
+    def top_chat(self, chat_id: int, limit: int = 10):
+        board = self._chats.get(chat_id)
+        return board.top(limit) if board else []
+
+    # ---- ventanas de ganancias ----
+    def _roll(self, period: str, key: str):
+        if self._current.get(period) != key:
+            self._current[period] = key
+            for stale in [k for k in self._windows if k[0] == period]:
+                del self._windows[stale]
+
+    def record_win(self, chat_id: int, user_id: int, prize: int, day: datetime.date = None):
+        for period, key in period_keys(day or datetime.date.today()).items():
+            self._roll(period, key)
+            for scope in (chat_id, None):
+                self._windows.setdefault((period, scope), Leaderboard()).add(user_id, prize)
+
+    def top_window(self, period: str, chat_id: int = None, limit: int = 10):
+        self._roll(period, period_keys(datetime.date.today())[period])
+        board = self._windows.get((period, chat_id))
+        return board.top(limit) if board else []
+
+    # ---- carga inicial ----
+    def load(self, balances, memberships, winnings):
+        """
+        Reconstruye los rankings al arrancar a partir de db.load_leaderboards():
+        balances [(user_id, balance)], memberships [(chat_id, user_id, balance)],
+        winnings [(day, chat_id, user_id, amount)] desde el inicio de la semana.
+        """
+        for user_id, balance in balances:
+            self.balances.update(user_id, balance)
+        for chat_id, user_id, balance in memberships:
+            self.joined(chat_id, user_id, balance)
+        for day, chat_id, user_id, amount in winnings:
+            day = datetime.date.fromisoformat(day)
+            if day == datetime.date.today():
+                self.record_win(chat_id, user_id, amount, day)
+            else:
+                # días anteriores de la semana sólo cuentan para "semana"
+                self._roll("semana", period_keys(day)["semana"])
+                for scope in (chat_id, None):
+                    self._windows.setdefault(("semana", scope), Leaderboard()).add(user_id, amount)
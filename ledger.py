@@ -0,0 +1,410 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# Cuándo se hace fsync del diario:
+#   always   -> antes de confirmar cada operación (nada confirmado se pierde)
+#   interval -> en cada volcado a SQLite (se pueden perder los últimos segundos)
+#   off      -> nunca; lo decide el sistema operativo
+FSYNC_MODES = ("always", "interval", "off")
+
+
+class Ledger:
+    """
+    Saldos en memoria con escritura diferida (write-behind).
+
+    Cada operación (apuesta, /dar, /regalar) se aplica al instante en memoria y
+    se anota como un registro en un diario append-only (JSON por línea). Un
+    volcado periódico o por tamaño lleva los registros pendientes a SQLite en
+    una sola transacción (group commit) con db.apply_journal(), que además
+    guarda el último `seq` aplicado. Al arrancar se reproducen los registros
+    del diario con seq mayor que ése, así que ninguna operación confirmada se
+    pierde ni se aplica dos veces.
+
+    El diario se divide en segmentos: cada volcado abre uno nuevo y borra los
+    que ya están en la BD. Un registro que la BD rechaza por sus datos (no por
+    un fallo pasajero) se aparta en <diario>.rejected y se deshace en memoria,
+    para que no bloquee los volcados siguientes.
+
+    Con journal_prefix=None no hay diario (BD en memoria, STORAGE_BACKEND=memory):
+    nada sobrevive al proceso, así que tampoco hay nada que reproducir.
+    """
+
+    def __init__(self, journal_prefix: Path = None, flush_interval: float = 1.0, flush_size: int = 500,
+                 fsync: str = "always", on_change=None):
+        if fsync not in FSYNC_MODES:
+            raise ValueError(f"LEDGER_FSYNC debe ser uno de {FSYNC_MODES}")
+        self.journal_prefix = Path(journal_prefix) if journal_prefix is not None else None
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.fsync = fsync
+        self.on_change = on_change  # callback(user_id, saldo) tras cada cambio
+        self.balances = {}
+        self._seq = None
+        self._segment = 0
+        self._pending = []          # registros aún no volcados a SQLite
+        self._buffer = []           # líneas aún no escritas en el diario
+        self._waiters = []
+        self._writer = None
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ledger")
+        self._file = None
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._size_flush = None
+        self.flushes = 0
+        self.flushed_entries = 0
+        self.rejected_entries = 0
+
+    # ---- ciclo de vida ----
+    async def open(self):
+        """Reproduce el diario pendiente en la BD, carga los saldos y arranca el volcado periódico."""
+        applied_seq, balances = await db.load_ledger()
+        segments = self._segments()
+        entries, last_seq = [], applied_seq
+        for _, path in segments:
+            for entry in self._read_segment(path):
+                last_seq = max(last_seq, entry["seq"])
+                if entry["seq"] > applied_seq:
+                    entries.append(entry)
+        if entries:
+            logger.warning("Ledger: reproduciendo %d operaciones del diario", len(entries))
+            # Los saldos se leen después: lo apartado no hay que deshacerlo en memoria
+            await self._apply(entries)
+            applied_seq, balances = await db.load_ledger()
+        for _, path in segments:
+            path.unlink()
+        self.balances = dict(balances)
+        self._seq = itertools.count(last_seq + 1)
+        self._segment = segments[-1][0] + 1 if segments else 1
+        self._flush_task = asyncio.create_task(self._flush_loop(), name="ledger-flush")
+
+    async def close(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        await self._drain()
+        await asyncio.get_running_loop().run_in_executor(self._io, self._close_file)
+
+    # ---- lecturas ----
+    def balance(self, user_id: int) -> int:
+        return self.balances.get(user_id, db.DEFAULT_START_BALANCE)
+
+    async def get_balance(self, user_id: int) -> int:
+        """Misma interfaz que SharedLedger: aquí la memoria es la fuente."""
+        return self.balance(user_id)
+
+    def open_account(self, user_id: int, balance: int = db.DEFAULT_START_BALANCE):
+        """Alta de un usuario recién creado en la BD (no pasa por el diario)."""
+        if user_id not in self.balances:
+            self._set(user_id, balance)
+
+    # ---- operaciones ----
+    async def place_bet(self, chat_id: int, round_id: int, user_id: int, bets) -> db.BetResult:
+        """
+        Débito condicional del total + apuestas [(CompiledBet, cantidad), ...] en
+        un solo registro. Comprobar y descontar ocurre sin ceder el event loop.
+        """
+        total = sum(amount for _, amount in bets)
+        balance = self.balance(user_id)
+        if total > balance:
+            return db.BetResult(db.BET_INSUFFICIENT_FUNDS, round_id, balance)
+        self._set(user_id, balance - total)
+        await self._log(db.TXN_BET, user_id, -total, chat=chat_id, round=round_id,
+                        bets=[[bet.token, bet.mask, bet.payout, amount] for bet, amount in bets])
+        return db.BetResult(db.BET_ACCEPTED, round_id, balance - total)
+
+    async def credit(self, user_id: int, amount: int, kind: str = db.TXN_GRANT):
+        """Devuelve el saldo nuevo, o None si pasaría de db.MAX_CHIPS."""
+        balance = self.balance(user_id) + amount
+        if balance > db.MAX_CHIPS:
+            return None
+        self._set(user_id, balance)
+        await self._log(kind, user_id, amount)
+        return balance
+
+    async def transfer(self, from_id: int, to_id: int, amount: int):
+        """Mueve fichas en un único registro del diario. Devuelve (saldo_origen, saldo_destino) o None."""
+        if amount > self.balance(from_id) or self.balance(to_id) + amount > db.MAX_CHIPS:
+            return None
+        self._set(from_id, self.balance(from_id) - amount)
+        self._set(to_id, self.balance(to_id) + amount)
+        await self._log(db.TXN_TRANSFER, from_id, -amount, to=to_id)
+        return self.balance(from_id), self.balance(to_id)
+
+    def apply_committed(self, user_id: int, delta: int):
+        """Refleja en memoria un cambio que ya está confirmado en la BD (p. ej. premios de settle_round)."""
+        self._set(user_id, self.balance(user_id) + delta)
+
+    # ---- volcado ----
+    async def flush(self):
+        """Lleva a SQLite, en una transacción, todo lo anotado hasta ahora."""
+        async with self._flush_lock:
+            await self._drain()
+            if not self._pending:
+                return
+            # Sin ceder el loop: lo que llegue desde aquí va al segmento siguiente
+            entries, self._pending = self._pending, []
+            closed_segment = self._segment
+            self._segment += 1
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._io, self._rotate)
+            try:
+                rejected = await self._apply(entries)
+            except Exception:
+                self._pending = entries + self._pending
+                raise
+            for entry in rejected:
+                self._revert(entry)
+            self.flushes += 1
+            self.flushed_entries += len(entries)
+            await loop.run_in_executor(self._io, self._remove_segments, closed_segment)
+
+    def stats(self) -> dict:
+        return {
+            "accounts": len(self.balances),
+            "pending": len(self._pending),
+            "flushes": self.flushes,
+            "flushed_entries": self.flushed_entries,
+            "rejected_entries": self.rejected_entries,
+        }
+
+    # ---- internos ----
+    def _set(self, user_id: int, balance: int):
+        self.balances[user_id] = balance
+        if self.on_change:
+            self.on_change(user_id, balance)
+
+    async def _apply(self, entries):
+        """
+        db.apply_journal(entries). Si la BD rechaza el lote por sus datos, se
+        aplica registro a registro y se apartan los que fallan; devuelve esos.
+        Un fallo pasajero (BD bloqueada, disco lleno...) se propaga y el lote
+        entero se reintenta en el próximo volcado.
+        """
+        data_errors = db.data_errors()
+        try:
+            await db.apply_journal(entries)
+            return []
+        except data_errors:
+            logger.exception("Ledger: la BD rechazó un lote de %d registros; se aplican uno a uno", len(entries))
+        rejected = []
+        for entry in entries:
+            try:
+                await db.apply_journal([entry])
+            except data_errors:
+                logger.exception("Ledger: registro rechazado y apartado: %s", entry)
+                rejected.append(entry)
+        if rejected:
+            self.rejected_entries += len(rejected)
+            await asyncio.get_running_loop().run_in_executor(self._io, self._write_rejected, rejected)
+        return rejected
+
+    def _revert(self, entry):
+        """Deshace en memoria un registro que nunca llegará a la BD."""
+        self._set(entry["user"], self.balance(entry["user"]) - entry["amount"])
+        if "to" in entry:
+            self._set(entry["to"], self.balance(entry["to"]) + entry["amount"])
+
+    async def _log(self, kind: str, user_id: int, amount: int, **fields):
+        entry = dict(seq=next(self._seq), kind=kind, user=user_id, amount=amount, ts=int(time.time()), **fields)
+        self._pending.append(entry)
+        if len(self._pending) >= self.flush_size and (self._size_flush is None or self._size_flush.done()):
+            self._size_flush = asyncio.create_task(self._safe_flush())
+        if self.journal_prefix is None:
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._buffer.append(json.dumps(entry, separators=(",", ":")))
+        self._waiters.append(fut)
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write_loop())
+        # La operación se confirma cuando su línea está escrita (y sincronizada si fsync=always)
+        try:
+            await fut
+        except Exception:
+            # Al usuario se le informa del error: la operación no debe llegar a la BD.
+            # _write_loop despierta a los que esperan antes de que flush() recoja _pending.
+            for i, pending in enumerate(self._pending):
+                if pending is entry:
+                    del self._pending[i]
+                    self._revert(entry)
+                    break
+            raise
+
+    async def _write_loop(self):
+        """Escribe en lote todo lo acumulado: un solo write + fsync para muchas operaciones."""
+        loop = asyncio.get_running_loop()
+        try:
+            while self._buffer:
+                lines, waiters = self._buffer, self._waiters
+                self._buffer, self._waiters = [], []
+                try:
+                    await loop.run_in_executor(self._io, self._write, lines, self._segment)
+                except Exception as e:
+                    logger.exception("Ledger: error escribiendo el diario")
+                    for fut in waiters:
+                        fut.set_exception(e)
+                else:
+                    for fut in waiters:
+                        fut.set_result(None)
+        finally:
+            self._writer = None
+
+    async def _drain(self):
+        while self._writer is not None:
+            await asyncio.shield(self._writer)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self._safe_flush()
+
+    async def _safe_flush(self):
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Ledger: error volcando a SQLite; se reintentará")
+
+    # ---- ficheros (sólo en el hilo del ledger) ----
+    def _segment_path(self, number: int) -> Path:
+        return self.journal_prefix.with_name(f"{self.journal_prefix.name}.{number:06d}")
+
+    def _segments(self):
+        found = []
+        if self.journal_prefix is None:
+            return found
+        for path in self.journal_prefix.parent.glob(f"{self.journal_prefix.name}.*"):
+            suffix = path.name.rsplit(".", 1)[1]
+            if suffix.isdigit():
+                found.append((int(suffix), path))
+        return sorted(found)
+
+    @staticmethod
+    def _read_segment(path: Path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # línea cortada por un corte de luz: nunca se llegó a confirmar
+                    logger.warning("Ledger: línea incompleta ignorada en %s", path)
+
+    def _write_rejected(self, entries):
+        if self.journal_prefix is None:
+            return  # ya están en el log
+        path = self.journal_prefix.with_name(f"{self.journal_prefix.name}.rejected")
+        with open(path, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(e, separators=(",", ":")) + "\n" for e in entries))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write(self, lines, segment: int):
+        if self._file is None or self._file.name != str(self._segment_path(segment)):
+            self._close_file()
+            self._file = open(self._segment_path(segment), "a", encoding="utf-8")
+        self._file.write("\n".join(lines) + "\n")
+        self._file.flush()
+        if self.fsync == "always":
+            os.fsync(self._file.fileno())
+
+    def _rotate(self):
+        if self._file is not None and self.fsync == "interval":
+            os.fsync(self._file.fileno())
+        self._close_file()
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _remove_segments(self, up_to: int):
+        for number, path in self._segments():
+            if number <= up_to:
+                path.unlink()
+
+
+class SharedLedger:
+    """
+    Saldos escritos directamente en la BD (write-through) para cuando varios
+    procesos comparten la BD (shard.py). Cada operación es una transacción con
+    débito condicional (db.place_bet_atomic, db.transfer, db.add_balance), así
+    que dos procesos nunca gastan el mismo saldo. La memoria sólo guarda el
+    último saldo visto, para los rankings.
+    Misma interfaz que Ledger; open/flush/close no tienen nada que hacer.
+    """
+
+    def __init__(self, on_change=None):
+        self.on_change = on_change
+        self.balances = {}
+        self.operations = 0
+
+    async def open(self):
+        pass
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def balance(self, user_id: int) -> int:
+        """Último saldo visto en este proceso (puede ir por detrás de otros shards)."""
+        return self.balances.get(user_id, db.DEFAULT_START_BALANCE)
+
+    async def get_balance(self, user_id: int) -> int:
+        balance = await db.get_balance(user_id)
+        self._set(user_id, balance)
+        return balance
+
+    def open_account(self, user_id: int, balance: int = db.DEFAULT_START_BALANCE):
+        if user_id not in self.balances:
+            self._set(user_id, balance)
+
+    async def place_bet(self, chat_id: int, round_id: int, user_id: int, bets) -> db.BetResult:
+        self.operations += 1
+        placed = await db.place_bet_atomic(chat_id, user_id, bets)
+        if placed.status == db.BET_ACCEPTED:
+            self._set(user_id, placed.balance)
+        elif placed.status == db.BET_INSUFFICIENT_FUNDS:
+            placed = placed._replace(balance=await self.get_balance(user_id))
+        return placed
+
+    async def credit(self, user_id: int, amount: int, kind: str = db.TXN_GRANT) -> int:
+        self.operations += 1
+        balance = await db.add_balance(user_id, amount)
+        if balance is not None:
+            self._set(user_id, balance)
+        return balance
+
+    async def transfer(self, from_id: int, to_id: int, amount: int):
+        self.operations += 1
+        moved = await db.transfer(from_id, to_id, amount)
+        if moved is not None:
+            self._set(from_id, moved[0])
+            self._set(to_id, moved[1])
+        return moved
+
+    def apply_committed(self, user_id: int, delta: int):
+        # Otro shard pudo cambiar el saldo: se olvida y se vuelve a leer de la BD
+        self.balances.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {"accounts": len(self.balances), "operations": self.operations}
+
+    def _set(self, user_id: int, balance: int):
+        self.balances[user_id] = balance
+        if self.on_change:
+            self.on_change(user_id, balance)
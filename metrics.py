@@ -0,0 +1,158 @@
+import cProfile
+import functools
+import logging
+import random
+import time
+from bisect import bisect_left
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Segundos: de 1 ms a 10 s
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # el último es +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+class Metrics:
+    """
+    Histogramas y contadores en memoria con salida en formato de texto de
+    Prometheus (GET /metrics). Sólo se usa desde el event loop.
+
+    Además de lo que se registra con observe()/inc(), cada render() vuelca
+    como gauges los stats() de los componentes añadidos con collect().
+    """
+
+    def __init__(self, namespace: str = "tilin"):
+        self.namespace = namespace
+        self._histograms = {}   # nombre -> {labels: Histogram}
+        self._counters = {}     # nombre -> {labels: valor}
+        self._buckets = {}
+        self._collectors = []   # (prefijo, callable -> dict)
+        # Perfilado por muestreo de un handler (ver timed())
+        self.profile_handler = None
+        self.profile_rate = 0.0
+        self.profile_dir = Path("profiles")
+        self.profiles = 0
+        self._profiling = False  # una sola muestra a la vez: cProfile es global al hilo
+
+    # ---- registro ----
+    def observe(self, name: str, value: float, buckets=LATENCY_BUCKETS, **labels):
+        series = self._histograms.setdefault(name, {})
+        key = tuple(labels.items())
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(self._buckets.setdefault(name, buckets))
+        histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self._counters.setdefault(name, {})
+        key = tuple(labels.items())
+        series[key] = series.get(key, 0) + value
+
+    def collect(self, prefix: str, stats):
+        """Publica los valores numéricos de stats() como `<namespace>_<prefix>_<clave>`."""
+        self._collectors.append((prefix, stats))
+
+    # ---- handlers ----
+    def timed(self, name: str, handler):
+        """Envuelve un handler: latencia, errores y, si toca, una muestra de cProfile."""
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            profiler = None
+            # Otra muestra en curso: ésta se la salta (si no, se pisarían en el mismo loop)
+            if name == self.profile_handler and not self._profiling and random.random() < self.profile_rate:
+                profiler = cProfile.Profile()
+                self._profiling = True
+            started = time.perf_counter()
+            try:
+                if profiler is not None:
+                    profiler.enable()
+                return await handler(update, context)
+            except Exception:
+                self.inc("handler_errors_total", handler=name)
+                raise
+            finally:
+                self.observe("handler_seconds", time.perf_counter() - started, handler=name)
+                if profiler is not None:
+                    profiler.disable()
+                    self._profiling = False
+                    self._dump(name, profiler)
+        return wrapper
+
+    def timed_call(self, name: str, **labels):
+        """Decorador para corrutinas que no son handlers (p. ej. spin_and_settle)."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - started, **labels)
+            return wrapper
+        return decorator
+
+    def profile(self, handler: str = None, rate: float = 0.0, directory: str = None):
+        """Activa (o con handler=None desactiva) el perfilado por muestreo de un handler."""
+        self.profile_handler = handler or None
+        self.profile_rate = max(0.0, min(1.0, rate))
+        if directory:
+            self.profile_dir = Path(directory)
+
+    def _dump(self, name: str, profiler: cProfile.Profile):
+        # cProfile mide el hilo entero: la muestra incluye lo que otras tareas
+        # ejecutaron mientras el handler esperaba. Sirve para ver qué pesa, no
+        # como tiempo exacto del handler.
+        try:
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(self.profile_dir / f"{name}-{time.time_ns()}.prof")
+            self.profiles += 1
+        except OSError:
+            logger.exception("No se pudo guardar el perfil de %s", name)
+
+    # ---- salida ----
+    def render(self) -> str:
+        ns = self.namespace
+        lines = []
+        for name, series in self._counters.items():
+            lines.append(f"# TYPE {ns}_{name} counter")
+            for key, value in series.items():
+                lines.append(f"{ns}_{name}{_labels(dict(key))} {value}")
+        for name, series in self._histograms.items():
+            lines.append(f"# TYPE {ns}_{name} histogram")
+            for key, h in series.items():
+                labels = dict(key)
+                cumulative = 0
+                for bound, count in zip(h.buckets + (float("inf"),), h.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{ns}_{name}_bucket{_labels({**labels, 'le': le})} {cumulative}")
+                lines.append(f"{ns}_{name}_sum{_labels(labels)} {h.sum}")
+                lines.append(f"{ns}_{name}_count{_labels(labels)} {h.count}")
+        for prefix, stats in self._collectors:
+            for key, value in stats().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f"# TYPE {ns}_{prefix}_{key} gauge")
+                    lines.append(f"{ns}_{prefix}_{key} {value}")
+        return "\n".join(lines) + "\n"
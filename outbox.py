@@ -0,0 +1,297 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Prioridades: menor número sale antes
+RESULT = 0   # resultados de la ruleta
+NORMAL = 1   # respuestas a comandos
+ACK = 2      # confirmaciones de apuesta (se pueden agrupar o descartar)
+
+MAX_TEXT = 4000      # margen bajo el límite de 4096 caracteres de Telegram
+MAX_ATTEMPTS = 3     # reintentos ante errores de red
+
+
+class _Message:
+    __slots__ = ("texts", "priority", "seq", "parse_mode", "reply_to", "not_before", "attempts",
+                 "reply_markup", "edit_id", "on_sent")
+
+    def __init__(self, text, priority, seq, parse_mode, reply_to, not_before,
+                 reply_markup=None, edit_id=None, on_sent=None):
+        self.texts = [text]
+        self.priority = priority
+        self.seq = seq
+        self.parse_mode = parse_mode
+        self.reply_to = reply_to
+        self.not_before = not_before
+        self.attempts = 0
+        self.reply_markup = reply_markup
+        self.edit_id = edit_id      # message_id a editar en vez de enviar uno nuevo
+        self.on_sent = on_sent      # callback(Message) tras enviarlo
+
+
+class _Chat:
+    __slots__ = ("queue", "bucket", "blocked_until", "pending_ack", "sending")
+
+    def __init__(self, bucket):
+        self.queue = []            # heap (prioridad, seq, _Message)
+        self.bucket = bucket
+        self.blocked_until = 0.0   # RetryAfter
+        self.pending_ack = None    # confirmación aún no enviada a la que agregar otras
+        self.sending = False       # hay un mensaje de este chat en vuelo
+
+
+class Outbox:
+    """
+    Cola de salida entre los handlers y `bot.send_message`.
+
+    - Cubetas de fichas global y por chat para respetar los límites de Telegram.
+    - Los resultados salen antes que las respuestas, y éstas antes que las
+      confirmaciones de apuesta.
+    - Las confirmaciones de un mismo chat que llegan dentro de `coalesce_seconds`
+      se agrupan en un solo mensaje.
+    - RetryAfter bloquea el chat el tiempo indicado y reencola el mensaje.
+    - Hasta `concurrency` envíos a la vez, pero como mucho uno por chat: los
+      mensajes de un grupo llegan en el orden en que salen de su cola.
+    `send()` no espera al envío: encola y vuelve. Las ediciones (`edit()`)
+    pasan por las mismas cubetas que los mensajes nuevos.
+    """
+
+    def __init__(self, global_rate: float = 25.0, chat_rate: float = 20 / 60, chat_burst: int = 3,
+                 coalesce_seconds: float = 1.5, max_queue: int = 10_000, concurrency: int = 8):
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.coalesce_seconds = coalesce_seconds
+        self.max_queue = max_queue
+        self._concurrency = concurrency
+        self._chats = {}
+        self._ready = []     # heap (prioridad, seq, chat_id): chats con mensaje listo
+        self._waiting = []   # heap (momento, chat_id): chats esperando cubeta/RetryAfter
+        self._seq = itertools.count()
+        self._event = asyncio.Event()
+        self._inflight = None
+        self._deliveries = set()   # tareas de envío en vuelo (referencia fuerte)
+        self._task = None
+        self._bot = None
+        self.depth = 0
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.failures = 0
+
+    # ---- ciclo de vida ----
+    def start(self, bot):
+        self._bot = bot
+        self._inflight = asyncio.Semaphore(self._concurrency)
+        self._task = asyncio.create_task(self._run(), name="outbox")
+
+    async def stop(self, timeout: float = 5.0):
+        """Intenta vaciar la cola durante `timeout` segundos y detiene el envío."""
+        deadline = time.monotonic() + timeout
+        while self.depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._deliveries:
+            await asyncio.gather(*self._deliveries, return_exceptions=True)
+
+    # ---- API ----
+    def send(self, chat_id: int, text: str, priority: int = NORMAL, parse_mode=None,
+             reply_to: int = None, coalesce: bool = False, reply_markup=None, on_sent=None) -> bool:
+        """Encola un mensaje. Devuelve False si se descartó por cola llena."""
+        if self.depth >= self.max_queue and priority >= ACK:
+            self.dropped += 1
+            return False
+        now = time.monotonic()
+        chat = self._chat(chat_id, now)
+        pending = chat.pending_ack
+        if coalesce and pending is not None and sum(map(len, pending.texts)) + len(text) < MAX_TEXT:
+            pending.texts.append(text)
+            pending.reply_to = None
+            self.coalesced += 1
+            return True
+        msg = _Message(text, priority, next(self._seq), parse_mode, reply_to,
+                       now + self.coalesce_seconds if coalesce else 0.0, reply_markup, on_sent=on_sent)
+        if coalesce:
+            chat.pending_ack = msg
+        self._push(chat_id, chat, msg, now)
+        return True
+
+    def edit(self, chat_id: int, message_id: int, text: str, priority: int = NORMAL,
+             parse_mode=None, reply_markup=None) -> bool:
+        """Encola la edición de un mensaje ya enviado."""
+        if self.depth >= self.max_queue and priority >= ACK:
+            self.dropped += 1
+            return False
+        now = time.monotonic()
+        msg = _Message(text, priority, next(self._seq), parse_mode, None, 0.0, reply_markup, message_id)
+        self._push(chat_id, self._chat(chat_id, now), msg, now)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "chats": len(self._chats),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "retries": self.retries,
+            "failures": self.failures,
+        }
+
+    # ---- internos ----
+    def _chat(self, chat_id: int, now: float) -> _Chat:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat(TokenBucket(self.chat_rate, self.chat_burst, now))
+        return chat
+
+    def _push(self, chat_id: int, chat: _Chat, msg: _Message, now: float):
+        heapq.heappush(chat.queue, (msg.priority, msg.seq, msg))
+        self.depth += 1
+        self._schedule(chat_id, chat, now)
+
+    def _schedule(self, chat_id: int, chat: _Chat, now: float):
+        priority, seq, msg = chat.queue[0]
+        ready_at = max(chat.blocked_until, msg.not_before)
+        if ready_at > now:
+            heapq.heappush(self._waiting, (ready_at, chat_id))
+        else:
+            heapq.heappush(self._ready, (priority, seq, chat_id))
+        self._event.set()
+
+    def _requeue(self, chat_id: int, msg: _Message):
+        now = time.monotonic()
+        self._push(chat_id, self._chat(chat_id, now), msg, now)
+
+    def _prune(self, now: float):
+        """Olvida los chats sin mensajes pendientes cuya cubeta ya está llena."""
+        idle = [cid for cid, chat in self._chats.items()
+                if not chat.queue and not chat.sending and chat.blocked_until <= now and chat.bucket.full(now)]
+        for cid in idle:
+            del self._chats[cid]
+
+    async def _run(self):
+        last_prune = time.monotonic()
+        while True:
+            now = time.monotonic()
+            while self._waiting and self._waiting[0][0] <= now:
+                _, chat_id = heapq.heappop(self._waiting)
+                chat = self._chats.get(chat_id)
+                if chat and chat.queue:
+                    self._schedule(chat_id, chat, now)
+            if now - last_prune > 60:
+                self._prune(now)
+                last_prune = now
+
+            if not self._ready:
+                self._event.clear()
+                timeout = self._waiting[0][0] - now if self._waiting else None
+                try:
+                    await asyncio.wait_for(self._event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            priority, seq, chat_id = heapq.heappop(self._ready)
+            chat = self._chats.get(chat_id)
+            if chat is None or not chat.queue or chat.queue[0][1] != seq:
+                continue  # entrada obsoleta
+            if chat.sending:
+                continue  # se vuelve a planificar cuando termine el envío en curso
+            msg = chat.queue[0][2]
+            ready_at = max(chat.blocked_until, msg.not_before)
+            if ready_at > now:
+                heapq.heappush(self._waiting, (ready_at, chat_id))
+                continue
+            wait = self.global_bucket.take(now)
+            if wait:
+                heapq.heappush(self._ready, (priority, seq, chat_id))
+                await asyncio.sleep(wait)
+                continue
+            wait = chat.bucket.take(now)
+            if wait:
+                self.global_bucket.refund()
+                heapq.heappush(self._waiting, (now + wait, chat_id))
+                continue
+
+            heapq.heappop(chat.queue)
+            self.depth -= 1
+            if chat.pending_ack is msg:
+                chat.pending_ack = None
+            chat.sending = True
+            await self._inflight.acquire()
+            task = asyncio.create_task(self._deliver(chat_id, msg))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, chat_id: int, msg: _Message):
+        try:
+            if msg.edit_id is not None:
+                await self._bot.edit_message_text(
+                    "\n".join(msg.texts),
+                    chat_id=chat_id,
+                    message_id=msg.edit_id,
+                    parse_mode=msg.parse_mode,
+                    reply_markup=msg.reply_markup,
+                )
+                self.sent += 1
+                return
+            sent = await self._bot.send_message(
+                chat_id,
+                "\n".join(msg.texts),
+                parse_mode=msg.parse_mode,
+                reply_to_message_id=msg.reply_to,
+                allow_sending_without_reply=True,
+                reply_markup=msg.reply_markup,
+            )
+            self.sent += 1
+        except RetryAfter as e:
+            self.retries += 1
+            chat = self._chat(chat_id, time.monotonic())
+            chat.blocked_until = time.monotonic() + e.retry_after
+            self._requeue(chat_id, msg)
+        except (BadRequest, Forbidden) as e:
+            if msg.edit_id is not None and "not modified" in str(e).lower():
+                return  # la edición no cambiaba nada
+            # Mensaje inválido o el bot ya no está en el chat: no tiene sentido reintentar
+            self.failures += 1
+            logger.warning("Mensaje descartado para el chat %s", chat_id, exc_info=True)
+        except NetworkError:
+            msg.attempts += 1
+            if msg.attempts < MAX_ATTEMPTS:
+                self.retries += 1
+                self._requeue(chat_id, msg)
+            else:
+                self.failures += 1
+                logger.exception("Error de red enviando al chat %s", chat_id)
+        except Exception:
+            self.failures += 1
+            logger.exception("Error enviando al chat %s", chat_id)
+        else:
+            if msg.on_sent:
+                try:
+                    msg.on_sent(sent)
+                except Exception:
+                    logger.exception("Error en on_sent del chat %s", chat_id)
+        finally:
+            self._inflight.release()
+            chat = self._chats.get(chat_id)
+            if chat is not None:
+                chat.sending = False
+                if chat.queue:
+                    self._schedule(chat_id, chat, time.monotonic())
@@ -0,0 +1,34 @@
+import time
+
+
+class TokenBucket:
+    """Cubeta de fichas: `rate` fichas por segundo, hasta `capacity` acumuladas."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: float = None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def take(self, now: float = None, tokens: float = 1) -> float:
+        """Consume `tokens` si hay. Devuelve 0.0 si se consumieron o los segundos que faltan."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    def refund(self, tokens: float = 1):
+        self.tokens = min(self.capacity, self.tokens + tokens)
+
+    def full(self, now: float = None) -> bool:
+        self._refill(time.monotonic() if now is None else now)
+        return self.tokens >= self.capacity
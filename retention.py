@@ -0,0 +1,73 @@
+"""
+Retención de bets y rounds.
+
+Las rondas liquidadas hace más de `max_age_days` se archivan (JSON por línea,
+gzip) en carpetas por fecha de liquidación:
+
+    archive/2026/10/18/rounds-1200-3199.jsonl.gz
+    archive/2026/10/18/bets-1200-3199.jsonl.gz
+
+y después se resumen en daily_stats / daily_numbers y se borran de la BD.
+Primero se escribe el archivo y luego se borra: si el proceso se corta entre
+medias, la siguiente pasada vuelve a archivar esas rondas (nunca se pierden).
+"""
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import db
+
+logger = logging.getLogger(__name__)
+
+
+def _write(folder: Path, name: str, rows):
+    """Escribe el archivo completo en un temporal y lo renombra: nunca queda uno a medias."""
+    folder.mkdir(parents=True, exist_ok=True)
+    path = folder / name
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+            for row in rows:
+                f.write(json.dumps(dict(row), separators=(",", ":")).encode() + b"\n")
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp, path)
+
+
+def _archive(archive_dir: Path, rounds, bets):
+    day_of = {r["id"]: r["day"] for r in rounds}
+    by_day = defaultdict(lambda: ([], []))
+    for r in rounds:
+        by_day[r["day"]][0].append(r)
+    for b in bets:
+        by_day[day_of[b["round_id"]]][1].append(b)
+    for day, (day_rounds, day_bets) in by_day.items():
+        folder = archive_dir.joinpath(*day.split("-"))
+        span = f"{day_rounds[0]['id']}-{day_rounds[-1]['id']}"
+        _write(folder, f"rounds-{span}.jsonl.gz", day_rounds)
+        _write(folder, f"bets-{span}.jsonl.gz", day_bets)
+
+
+async def compact(max_age_days: float, archive_dir: Path, batch: int = 2000) -> dict:
+    """Archiva, resume y borra por lotes todas las rondas antiguas; luego libera espacio."""
+    before = int(time.time() - max_age_days * 86400)
+    totals = {"rounds": 0, "bets": 0, "pages_freed": 0}
+    while True:
+        rounds, bets = await db.load_settled_rounds(before, batch)
+        if not rounds:
+            break
+        # gzip fuera del hilo de la BD: las apuestas siguen entrando mientras tanto
+        await asyncio.to_thread(_archive, Path(archive_dir), rounds, bets)
+        deleted_rounds, deleted_bets = await db.compact_rounds([r["id"] for r in rounds])
+        totals["rounds"] += deleted_rounds
+        totals["bets"] += deleted_bets
+        if len(rounds) < batch:
+            break
+    if totals["rounds"]:
+        totals["pages_freed"] = await db.incremental_vacuum()
+    return totals
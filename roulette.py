@@ -1,4 +1,7 @@
 import random
+from collections import namedtuple
+from functools import lru_cache
+
 NUMBERS = list(range(37))  # 0..36
 RED_NUMBERS = {1,3,5,7,9,12,14,16,18,19,21,23,25,27,30,32,34,36}
 
@@ -6,4 +9,91 @@ def spin():
     return random.choice(NUMBERS)
 
 def is_red(number: int) -> bool:
-    return number in RED_NUMBERS
\ No newline at end of file
+    return number in RED_NUMBERS
+
+
+# -------------------------
+# Compilador de apuestas
+# -------------------------
+# Cada apuesta se compila una sola vez (al apostar) a una máscara de 37 bits con
+# los números que gana y a su multiplicador de pago. Liquidar es entonces un
+# test de bit y una multiplicación: (mask >> resultado) & 1 -> amount * payout.
+CompiledBet = namedtuple("CompiledBet", "token mask payout")
+
+
+def _mask(numbers) -> int:
+    mask = 0
+    for n in numbers:
+        mask |= 1 << n
+    return mask
+
+
+# Multiplicador total (incluye la apuesta) según cuántos números cubre: 36 / n
+PAYOUTS = {1: 36, 2: 18, 3: 12, 4: 9, 6: 6, 12: 3, 18: 2}
+
+NAMED_BETS = {
+    "rojo": _mask(RED_NUMBERS),
+    "negro": _mask(n for n in range(1, 37) if n not in RED_NUMBERS),
+    "par": _mask(range(2, 37, 2)),
+    "impar": _mask(range(1, 37, 2)),
+    "bajo": _mask(range(1, 19)),
+    "alto": _mask(range(19, 37)),
+    "docena1": _mask(range(1, 13)),
+    "docena2": _mask(range(13, 25)),
+    "docena3": _mask(range(25, 37)),
+    "columna1": _mask(range(1, 37, 3)),
+    "columna2": _mask(range(2, 37, 3)),
+    "columna3": _mask(range(3, 37, 3)),
+}
+
+
+def _table_combinations():
+    """Máscaras de los splits, streets, corners y líneas válidos del paño."""
+    combos = [
+        {0, 1}, {0, 2}, {0, 3},   # splits con el cero
+        {0, 1, 2}, {0, 2, 3},     # streets con el cero
+        {0, 1, 2, 3},             # "primeros cuatro" (paga como corner)
+    ]
+    for n in range(1, 37):
+        right_edge = (n - 1) % 3 == 2
+        if not right_edge:
+            combos.append({n, n + 1})                       # split horizontal
+        if n + 3 <= 36:
+            combos.append({n, n + 3})                       # split vertical
+        if not right_edge and n + 4 <= 36:
+            combos.append({n, n + 1, n + 3, n + 4})         # corner
+    for first in range(1, 37, 3):
+        combos.append({first, first + 1, first + 2})        # street (fila)
+        if first + 5 <= 36:
+            combos.append(set(range(first, first + 6)))     # línea (dos filas)
+    return {_mask(c) for c in combos}
+
+
+COMBINATION_MASKS = _table_combinations()
+
+
+@lru_cache(maxsize=4096)
+def compile_bet(token: str) -> CompiledBet:
+    """Compila un token de /apostar. Lanza ValueError si no es una apuesta válida."""
+    token = token.lower().strip()
+    if token in NAMED_BETS:
+        mask = NAMED_BETS[token]
+    elif "-" in token:
+        parts = token.split("-")
+        if not all(p.isdigit() for p in parts):
+            raise ValueError(f"apuesta no válida: {token}")
+        numbers = sorted(int(p) for p in parts)
+        mask = _mask(numbers)
+        if len(set(numbers)) != len(numbers) or mask not in COMBINATION_MASKS:
+            raise ValueError(f"combinación no válida: {token}")
+        token = "-".join(str(n) for n in numbers)
+    elif token.isdigit() and 0 <= int(token) <= 36:
+        token = str(int(token))
+        mask = _mask([int(token)])
+    else:
+        raise ValueError(f"apuesta no válida: {token}")
+    return CompiledBet(token, mask, PAYOUTS[bin(mask).count("1")])
+
+
+def wins(mask: int, number: int) -> bool:
+    return (mask >> number) & 1 == 1
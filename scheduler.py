@@ -0,0 +1,173 @@
+import asyncio
+import heapq
+import logging
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+
+class RoundScheduler:
+    """
+    Planificador único para todas las mesas de ruleta activas.
+
+    Un solo bucle duerme hasta el próximo giro de un heap (momento, chat_id).
+    Al activar una mesa se elige para su primer giro el segundo menos ocupado
+    alrededor de `ahora + intervalo`, así los grupos que se activan a la vez no
+    giran (ni envían mensajes) en el mismo instante. Después cada mesa conserva
+    su fase: el siguiente giro se planifica desde el previsto, no desde el real.
+    """
+
+    def __init__(self, default_interval: int, on_spin=None):
+        self.default_interval = default_interval
+        self.on_spin = on_spin    # callback(chat_id, retraso) en cada giro
+        self._callback = None     # async callback(chat_id)
+        self._heap = []           # (momento, generación, chat_id)
+        self._tables = {}         # chat_id -> [intervalo, próximo_giro, generación]
+        self._slots = Counter()   # segundo -> mesas que giran en ese segundo
+        self._generation = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._running = set()
+        # Retraso entre el giro planificado y el real
+        self.spins = 0
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.lag_total = 0.0
+
+    # ---- ciclo de vida ----
+    def start(self, callback):
+        self._callback = callback
+        self._task = asyncio.create_task(self._run(), name="round-scheduler")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+    # ---- mesas ----
+    def is_active(self, chat_id: int) -> bool:
+        return chat_id in self._tables
+
+    def interval(self, chat_id: int):
+        table = self._tables.get(chat_id)
+        return table[0] if table else None
+
+    def next_spin(self, chat_id: int):
+        table = self._tables.get(chat_id)
+        return table[1] if table else None
+
+    def add(self, chat_id: int, interval: int = None, first: float = None) -> float:
+        """Activa (o reprograma) la mesa. Devuelve el momento (time.time()) del primer giro."""
+        interval = interval or self.default_interval
+        if first is None:
+            first = self._least_busy(time.time() + interval, interval)
+        self.remove(chat_id)
+        self._generation += 1
+        self._tables[chat_id] = [interval, first, self._generation]
+        self._push(chat_id)
+        return first
+
+    def restore(self, tables, spread: int = 30) -> int:
+        """
+        Re-arma mesas guardadas [(chat_id, intervalo, próximo_giro), ...] tras un
+        reinicio. Las que conservan su próximo giro siguen en su fase; las que se
+        lo perdieron con el bot parado se reparten por los segundos menos ocupados
+        de los próximos `spread` segundos en vez de girar todas a la vez.
+        Devuelve cuántas estaban atrasadas.
+        """
+        now = time.time()
+        overdue = 0
+        for chat_id, interval, at in tables:
+            interval = interval or self.default_interval
+            if at is None or at <= now or at > now + interval:
+                window = max(1, min(spread, interval))
+                at = self._least_busy(now + window / 2, window)
+                overdue += 1
+            self.add(chat_id, interval, first=at)
+        return overdue
+
+    def remove(self, chat_id: int) -> bool:
+        """Desactiva la mesa; su entrada en el heap queda obsoleta y se descarta al salir."""
+        table = self._tables.pop(chat_id, None)
+        if table is None:
+            return False
+        self._release(table[1])
+        return True
+
+    def __len__(self):
+        return len(self._tables)
+
+    def stats(self) -> dict:
+        return {
+            "tables": len(self._tables),
+            "spins": self.spins,
+            "lag_last": self.lag_last,
+            "lag_max": self.lag_max,
+            "lag_avg": self.lag_total / self.spins if self.spins else 0.0,
+        }
+
+    # ---- internos ----
+    def _least_busy(self, target: float, interval: int) -> float:
+        """El segundo con menos giros en [target - intervalo/2, target + intervalo/2)."""
+        half = interval // 2
+        base = int(target)
+        best = min(range(-half, interval - half), key=lambda d: (self._slots[base + d], abs(d)))
+        return target + best
+
+    def _release(self, at: float):
+        slot = int(at)
+        self._slots[slot] -= 1
+        if self._slots[slot] <= 0:
+            del self._slots[slot]
+
+    def _push(self, chat_id: int):
+        interval, at, generation = self._tables[chat_id]
+        self._slots[int(at)] += 1
+        heapq.heappush(self._heap, (at, generation, chat_id))
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                at, generation, chat_id = heapq.heappop(self._heap)
+                table = self._tables.get(chat_id)
+                if table is None or table[2] != generation:
+                    continue  # mesa desactivada o reprogramada
+                self._fire(chat_id, at, now)
+                interval = table[0]
+                self._release(at)
+                # Conserva la fase; si vamos muy atrasados, salta los giros perdidos
+                table[1] = at + interval * max(1, int((now - at) // interval) + 1)
+                self._push(chat_id)
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _fire(self, chat_id: int, planned: float, now: float):
+        lag = max(0.0, now - planned)
+        self.spins += 1
+        self.lag_last = lag
+        self.lag_max = max(self.lag_max, lag)
+        self.lag_total += lag
+        if self.on_spin:
+            self.on_spin(chat_id, lag)
+        task = asyncio.create_task(self._spin(chat_id))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _spin(self, chat_id: int):
+        try:
+            await self._callback(chat_id)
+        except Exception:
+            logger.exception("Error en el giro del chat %s", chat_id)
@@ -0,0 +1,321 @@
+"""
+Modo multiproceso: un proceso frontal recibe los Updates (polling, webhook o
+una fuente sintética) y los reparte por chat_id entre N procesos worker.
+
+Cada worker es un bot completo (bot.py con SHARD_INDEX/SHARD_COUNT) que sólo
+lleva sus chats: rondas, liquidación, tablero y cola de salida. Los saldos van
+por SharedLedger (directo en la BD con débitos condicionales), así que /dar y
+/regalar entre usuarios que caen en shards distintos usan la misma BD
+(SQLite o PostgreSQL, ver storage.py).
+
+    python shard.py --workers 4                          # polling (BOT_MODE=webhook para webhook)
+    python shard.py --workers 1 --fake --chats 200       # carga sintética sin Telegram...
+    python shard.py --workers 4 --fake --chats 200       # ...para comparar el throughput
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+BATCH = 256            # updates por mensaje a un worker
+POLL_TIMEOUT = 30      # long polling de getUpdates, en segundos
+
+
+def route_key(update: dict) -> int:
+    """chat_id del Update; si no tiene chat (p. ej. inline), el id del usuario."""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        if value.get("from"):
+            return value["from"]["id"]
+    return 0
+
+
+class Router:
+    """Reparte Updates (dict) entre las colas de los workers: chat_id % N, como bot.owns_chat()."""
+
+    def __init__(self, queues, batch: int = BATCH):
+        self.queues = queues
+        self.batch = batch
+        self._pending = [[] for _ in queues]
+        self.routed = Counter()
+
+    def put(self, update: dict):
+        shard = route_key(update) % len(self.queues)
+        pending = self._pending[shard]
+        pending.append(update)
+        if len(pending) >= self.batch:
+            self._send(shard)
+
+    def flush(self):
+        for shard, pending in enumerate(self._pending):
+            if pending:
+                self._send(shard)
+
+    def close(self):
+        self.flush()
+        for queue in self.queues:
+            queue.put(None)
+
+    def stats(self) -> dict:
+        return {f"shard_{shard}": count for shard, count in sorted(self.routed.items())}
+
+    def _send(self, shard: int):
+        self.queues[shard].put(self._pending[shard])
+        self.routed[shard] += len(self._pending[shard])
+        self._pending[shard] = []
+
+
+# -------------------------
+# Workers
+# -------------------------
+def worker(index: int, count: int, inbox, results, fake: bool, concurrency: int):
+    # Ctrl+C llega a todo el grupo de procesos: el frontal es quien cierra, con None
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.environ.update({"SHARD_INDEX": str(index), "SHARD_COUNT": str(count), "LEDGER_MODE": "shared"})
+    if fake:
+        from bench import bench_env
+        os.environ.setdefault("BOT_TOKEN", "1:bench")
+        os.environ.update(bench_env(concurrency))
+    results.put(asyncio.run(_serve_shard(index, inbox, fake)))
+
+
+async def _serve_shard(index: int, inbox, fake: bool) -> dict:
+    # bot lee SHARD_* al importarse: después de preparar el entorno
+    import bot
+    from telegram import Update
+
+    request = None
+    if fake:
+        from bench import FakeRequest
+        request = FakeRequest()
+    app = bot.build_app(webhook=True, request=request)
+    loop = asyncio.get_running_loop()
+    processed, started = 0, None
+    await app.initialize()
+    await bot.post_init(app)
+    await app.start()
+    try:
+        while True:
+            batch = await loop.run_in_executor(None, inbox.get)
+            if batch is None:
+                break
+            if started is None:
+                started = time.perf_counter()
+            for data in batch:
+                await app.update_queue.put(Update.de_json(data, app.bot))
+            processed += len(batch)
+    finally:
+        await app.stop()   # espera a que se procesen los updates pendientes
+        elapsed = time.perf_counter() - started if started else 0.0
+        await bot.post_stop(app)
+        await app.shutdown()
+        await bot.post_shutdown(app)
+    return {
+        "shard": index,
+        "updates": processed,
+        "seconds": elapsed,
+        "api_calls": dict(request.calls) if request else {},
+        "ledger": bot.ledger.stats(),
+    }
+
+
+# -------------------------
+# Fuentes de Updates
+# -------------------------
+async def poll(router: Router, token: str):
+    from telegram import Bot, Update
+    from telegram.error import NetworkError, RetryAfter
+
+    async with Bot(token) as telegram_bot:
+        await telegram_bot.delete_webhook()
+        offset = None
+        try:
+            while True:
+                try:
+                    updates = await telegram_bot.get_updates(offset=offset, timeout=POLL_TIMEOUT,
+                                                             allowed_updates=Update.ALL_TYPES)
+                except RetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                except NetworkError:
+                    logger.warning("getUpdates falló; reintentando", exc_info=True)
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    router.put(update.to_dict())
+                    offset = update.update_id + 1
+                router.flush()
+        finally:
+            if offset is not None:
+                # Confirma a Telegram lo ya repartido para no recibirlo otra vez al arrancar
+                await telegram_bot.get_updates(offset=offset, timeout=0, limit=1)
+
+
+async def serve_webhook(router: Router, stop_event: asyncio.Event):
+    from telegram import Bot, Update
+    from webhook import WebhookServer, resolve_secret
+
+    async def handle_update(data: dict):
+        router.put(data)
+        router.flush()
+
+    url = os.getenv("WEBHOOK_URL", "")
+    path = os.getenv("WEBHOOK_PATH", "/telegram")
+    secret = resolve_secret(os.getenv("WEBHOOK_SECRET", ""), url)
+    max_connections = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+    server = WebhookServer(handle_update, path=path, secret=secret, health=router.stats,
+                           max_connections=max_connections)
+    await server.start(os.getenv("WEBHOOK_LISTEN", "0.0.0.0"), int(os.getenv("WEBHOOK_PORT", "8443")))
+    try:
+        if url:
+            async with Bot(os.getenv("BOT_TOKEN")) as telegram_bot:
+                await telegram_bot.set_webhook(url=url.rstrip("/") + path, secret_token=secret,
+                                               max_connections=max_connections,
+                                               allowed_updates=Update.ALL_TYPES)
+        await stop_event.wait()
+    finally:
+        await server.stop()
+
+
+def fake_updates(args):
+    """Mismo reparto que bench.py: activar mesas y, por ronda, apuestas, regalos y rankings."""
+    from bench import ADMIN_ID, BET_TOKENS, command
+
+    rng = random.Random(args.seed)
+    chats = [-1000 - i for i in range(args.chats)]
+    users = [1000 + i for i in range(args.users)]
+    updates = [command("/ruleta_on", c, ADMIN_ID) for c in chats]
+    for _ in range(args.rounds):
+        updates += [command(f"/apostar {rng.randint(1, 10)} {rng.choice(BET_TOKENS)}", c, rng.choice(users))
+                    for _ in range(args.bets) for c in chats]
+        # El destinatario puede caer en cualquier shard: pasa por el ledger compartido
+        updates += [command(f"/regalar {rng.randint(1, 5)}", c, rng.choice(users), reply_to_user=rng.choice(users))
+                    for _ in range(args.gifts) for c in chats]
+        updates += [command("/ranking", c, rng.choice(users)) for _ in range(args.rankings) for c in chats]
+    return updates
+
+
+# -------------------------
+# Frontal
+# -------------------------
+async def prepare_db():
+    """Migra y vuelca el diario de una ejecución en un solo proceso antes de repartir los saldos."""
+    import db
+    from ledger import Ledger
+
+    await db.migrate()
+    journal = Ledger(db.DB_FILE.with_suffix(".journal"))
+    await journal.open()
+    await journal.close()
+    await db.close()
+
+
+async def front(args, router: Router):
+    if args.fake:
+        updates = fake_updates(args)
+        for update in updates:
+            router.put(update)
+        return
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:  # Windows
+            pass
+    if os.getenv("BOT_MODE", "polling").lower() == "webhook":
+        await serve_webhook(router, stop_event)
+        return
+    polling = asyncio.create_task(poll(router, os.getenv("BOT_TOKEN")))
+    await stop_event.wait()
+    polling.cancel()
+    try:
+        await polling
+    except asyncio.CancelledError:
+        pass
+
+
+def run(args):
+    asyncio.run(prepare_db())
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue() for _ in range(args.workers)]
+    results = context.Queue()
+    processes = [context.Process(target=worker, name=f"shard-{i}",
+                                 args=(i, args.workers, queues[i], results, args.fake, args.concurrency))
+                 for i in range(args.workers)]
+    for process in processes:
+        process.start()
+    router = Router(queues)
+    started = time.perf_counter()
+    try:
+        asyncio.run(front(args, router))
+    finally:
+        router.close()
+        reports = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    wall = time.perf_counter() - started
+    return sorted(reports, key=lambda r: r["shard"]), wall
+
+
+def print_report(reports, wall: float):
+    total = sum(r["updates"] for r in reports)
+    print(f"{len(reports)} workers: {total} updates en {wall:.1f}s ({total / wall:.0f}/s)")
+    for r in reports:
+        rate = r["updates"] / r["seconds"] if r["seconds"] else 0.0
+        print(f"  shard {r['shard']}: {r['updates']} updates en {r['seconds']:.1f}s ({rate:.0f}/s) "
+              f"ledger={r['ledger']}")
+    api_calls = Counter()
+    for r in reports:
+        api_calls.update(r["api_calls"])
+    if api_calls:
+        print("API:", dict(api_calls))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--fake", action="store_true", help="Updates sintéticos en un casino.db temporal")
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--bets", type=int, default=100, help="apuestas por ronda y grupo")
+    parser.add_argument("--gifts", type=int, default=5, help="/regalar por ronda y grupo")
+    parser.add_argument("--rankings", type=int, default=5, help="/ranking por ronda y grupo")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=64, help="CONCURRENT_UPDATES de cada worker")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    load_dotenv()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
+    if os.getenv("STORAGE_BACKEND", "sqlite").lower() == "memory":
+        raise SystemExit("Los workers comparten la BD: usa STORAGE_BACKEND=sqlite o postgres")
+
+    if args.fake:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        with tempfile.TemporaryDirectory(prefix="tilin-shard-") as tmp:
+            os.chdir(tmp)  # los workers heredan el directorio: casino.db temporal
+            print_report(*run(args))
+        return
+    if not os.getenv("BOT_TOKEN"):
+        raise SystemExit("Falta BOT_TOKEN en .env")
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Simulador Monte Carlo de la ruleta (NumPy) para comprobar pagos y ventaja de la casa.
+
+Usa las mismas reglas que el bot: roulette.compile_bet() para las apuestas que
+acepta /apostar y roulette.wins() + payout para liquidarlas, como settle_round.
+
+    python simulate.py                                   # todas las apuestas aceptadas
+    python simulate.py --spins 10000000 --mix rojo:3,17:1,docena1:1 --stake 20 --rounds 2000
+
+Informa por tipo de apuesta del RTP exacto y simulado y de la desviación típica
+por ficha apostada, y de la probabilidad de quedarse sin saldo partiendo de
+DEFAULT_START_BALANCE con la mezcla de apuestas dada. Sale con código 1 si
+alguna apuesta aceptada tiene un RTP claramente incorrecto.
+"""
+import argparse
+import random
+import sys
+
+import numpy as np
+
+import roulette
+from db import DEFAULT_START_BALANCE
+
+# Con pagos 36/n sobre 37 números, toda apuesta devuelve 36/37 (ventaja del 2,7 %)
+EXPECTED_RTP = 36 / 37
+DEFAULT_MIX = "rojo:4,par:2,impar:2,docena1:1,columna2:1,17:1,1-2:1,1-2-4-5:1"
+
+
+def accepted_bets():
+    """Todas las apuestas que acepta /apostar: con nombre, plenos y combinaciones del paño."""
+    tokens = list(roulette.NAMED_BETS) + [str(n) for n in roulette.NUMBERS]
+    for mask in roulette.COMBINATION_MASKS:
+        tokens.append("-".join(str(n) for n in roulette.NUMBERS if roulette.wins(mask, n)))
+    return [roulette.compile_bet(token) for token in tokens]
+
+
+def payout_table(bets) -> np.ndarray:
+    """Fila por apuesta y columna por número: lo que devuelve cada ficha apostada."""
+    table = np.zeros((len(bets), len(roulette.NUMBERS)))
+    for i, bet in enumerate(bets):
+        for number in roulette.NUMBERS:
+            if roulette.wins(bet.mask, number):
+                table[i, number] = bet.payout
+    return table
+
+
+def check_spin(samples: int = 370_000) -> float:
+    """Chi-cuadrado de roulette.spin() frente a la uniforme: NumPy sólo es válido si spin() lo es."""
+    counts = np.bincount([roulette.spin() for _ in range(samples)], minlength=len(roulette.NUMBERS))
+    expected = samples / len(roulette.NUMBERS)
+    return float(((counts - expected) ** 2 / expected).sum())
+
+
+def spin_counts(rng, spins: int, chunk: int = 10_000_000) -> np.ndarray:
+    """Veces que sale cada número en `spins` tiradas, por trozos para acotar la memoria."""
+    counts = np.zeros(len(roulette.NUMBERS), dtype=np.int64)
+    while spins > 0:
+        n = min(spins, chunk)
+        counts += np.bincount(rng.integers(0, len(roulette.NUMBERS), n), minlength=len(roulette.NUMBERS))
+        spins -= n
+    return counts
+
+
+def bet_stats(bets, counts: np.ndarray) -> list:
+    """RTP exacto y simulado, error típico y desviación típica del retorno por ficha."""
+    table = payout_table(bets)
+    spins = counts.sum()
+    probabilities = np.full(len(roulette.NUMBERS), 1 / len(roulette.NUMBERS))
+    exact = table @ probabilities
+    exact_std = np.sqrt(table ** 2 @ probabilities - exact ** 2)
+    simulated = table @ counts / spins
+    variance = table ** 2 @ counts / spins - simulated ** 2
+    return [
+        {
+            "token": bet.token,
+            "covers": bin(bet.mask).count("1"),
+            "payout": bet.payout,
+            "exact_rtp": float(exact[i]),
+            "rtp": float(simulated[i]),
+            "stderr": float(exact_std[i] / np.sqrt(spins)),
+            "std": float(np.sqrt(variance[i])),
+        }
+        for i, bet in enumerate(bets)
+    ]
+
+
+def ruin(rng, mix, stake: int, rounds: int, players: int, balance: int = DEFAULT_START_BALANCE,
+         chunk: int = 2_000) -> dict:
+    """
+    `players` jugadores que apuestan `stake` por ronda a una apuesta de la mezcla
+    (elegida según su peso). Se arruina quien no llega a cubrir la apuesta antes
+    de `rounds` rondas; el resto acaba con el saldo final.
+    """
+    bets = [bet for bet, _ in mix]
+    weights = np.array([weight for _, weight in mix], dtype=float)
+    table = payout_table(bets)
+    ruined, finals = 0, []
+    for start in range(0, players, chunk):
+        n = min(chunk, players - start)
+        choice = rng.choice(len(bets), size=(n, rounds), p=weights / weights.sum())
+        numbers = rng.integers(0, len(roulette.NUMBERS), size=(n, rounds))
+        path = balance + np.cumsum(stake * (table[choice, numbers] - 1), axis=1)
+        # Camino como si siguiera jugando: se arruina la primera vez que no cubre la apuesta
+        broke = (path < stake).any(axis=1)
+        ruined += int(broke.sum())
+        finals.append(path[~broke, -1])
+    finals = np.concatenate(finals)
+    return {
+        "players": players,
+        "ruin_probability": ruined / players,
+        "median_final": float(np.median(finals)) if finals.size else 0.0,
+    }
+
+
+def parse_mix(text: str):
+    mix = []
+    for part in text.split(","):
+        token, _, weight = part.partition(":")
+        mix.append((roulette.compile_bet(token), float(weight or 1)))
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--spins", type=int, default=5_000_000, help="tiradas para el RTP de cada apuesta")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="apuestas token:peso para la ruina")
+    parser.add_argument("--stake", type=int, default=10, help="fichas por ronda")
+    parser.add_argument("--rounds", type=int, default=1000, help="rondas por jugador")
+    parser.add_argument("--players", type=int, default=10_000)
+    parser.add_argument("--balance", type=int, default=DEFAULT_START_BALANCE, help="saldo inicial")
+    parser.add_argument("--tolerance", type=float, default=0.005, help="desvío admitido del RTP exacto respecto a 36/37")
+    parser.add_argument("--sigmas", type=float, default=6.0, help="desvío admitido de la simulación, en errores típicos")
+    parser.add_argument("--all", action="store_true", help="lista todas las combinaciones, no sólo los fallos")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+    random.seed(args.seed)
+    errors = []
+
+    chi2 = check_spin()
+    # 36 grados de libertad: por encima de ~100 la probabilidad es < 1e-7
+    if chi2 > 100:
+        errors.append(f"roulette.spin() no es uniforme (chi2={chi2:.1f})")
+
+    bets = accepted_bets()
+    stats = bet_stats(bets, spin_counts(rng, args.spins))
+    shown = {bet.token for bet, _ in parse_mix(args.mix)} | set(roulette.NAMED_BETS)
+    print(f"{args.spins} tiradas, {len(bets)} apuestas aceptadas")
+    print(f"  {'apuesta':<12} {'núms':>4} {'paga':>4} {'RTP exacto':>10} {'RTP sim.':>9} {'± err':>7} {'desv.':>6}")
+    for s in stats:
+        wrong = []
+        if abs(s["exact_rtp"] - EXPECTED_RTP) > args.tolerance:
+            wrong.append(f"RTP exacto {s['exact_rtp']:.4f}, se esperaba {EXPECTED_RTP:.4f}")
+        if abs(s["rtp"] - s["exact_rtp"]) > args.sigmas * s["stderr"]:
+            wrong.append(f"RTP simulado {s['rtp']:.4f} fuera de {args.sigmas:g} errores típicos")
+        errors += [f"{s['token']}: {w}" for w in wrong]
+        if wrong or args.all or s["token"] in shown:
+            print(f"  {s['token']:<12} {s['covers']:>4} {s['payout']:>4} {s['exact_rtp']:>10.4f} "
+                  f"{s['rtp']:>9.4f} {s['stderr']:>7.4f} {s['std']:>6.2f}{'  <-- ' if wrong else ''}")
+
+    result = ruin(rng, parse_mix(args.mix), args.stake, args.rounds, args.players, args.balance)
+    print(f"Ruina con {args.balance} fichas, {args.stake} por ronda y {args.rounds} rondas "
+          f"({args.mix}): {100 * result['ruin_probability']:.2f}% de {result['players']} jugadores; "
+          f"saldo final mediano de los demás {result['median_final']:.0f}")
+
+    if errors:
+        print("\nRTP INCORRECTO:", file=sys.stderr)
+        for error in errors:
+            print(f"  {error}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
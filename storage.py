@@ -0,0 +1,404 @@
+"""
+Motores de almacenamiento de db.py.
+
+db.py es el repositorio que usa el bot (usuarios, saldos, rondas, apuestas...):
+sus funciones escriben SQL y piden una conexión al motor configurado, que
+además resuelve lo que cambia entre motores (conexiones, bloqueo de escritura,
+fechas, esquema y vacuum).
+
+  sqlite    fichero SQLite con WAL (por defecto, DB_PATH)
+  memory    SQLite en memoria: sin disco, para pruebas y bancos de pruebas
+  postgres  servidor PostgreSQL con pool de conexiones (DATABASE_URL)
+
+Se elige con STORAGE_BACKEND en .env (ver from_env()).
+"""
+import logging
+import os
+import sqlite3
+from decimal import Decimal
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("sqlite", "memory", "postgres")
+
+
+class SQLiteStorage:
+    """Fichero SQLite: una sola conexión de larga duración, usada sólo desde el hilo de la BD."""
+
+    name = "sqlite"
+    threads = 1
+    # Errores que se repiten con los mismos datos: reintentar no sirve (ver Ledger.flush)
+    data_errors = (sqlite3.IntegrityError, sqlite3.DataError)
+
+    def __init__(self, path="casino.db"):
+        self.path = str(path)
+        self._conn = None
+
+    # ---- conexiones ----
+    def acquire(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._configure(self._conn)
+        return self._conn
+
+    def release(self, conn):
+        pass
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _configure(self, conn):
+        # Sólo tiene efecto en una BD nueva; las existentes se convierten en migrate()
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        # WAL: los lectores no bloquean al escritor y cada commit es un append.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-16000")
+        conn.execute("PRAGMA busy_timeout=5000")
+
+    # ---- dialecto ----
+    def begin_write(self, c):
+        """Abre una transacción que lee antes de escribir, ya con el lock de escritura."""
+        c.execute("BEGIN IMMEDIATE")
+
+    @staticmethod
+    def day(column: str) -> str:
+        """Expresión SQL: fecha local AAAA-MM-DD de una columna epoch."""
+        return f"date({column}, 'unixepoch', 'localtime')"
+
+    def migrate(self, conn, migrations):
+        """
+        Cada migración recibe un cursor y se aplica una sola vez, dentro de su
+        propia transacción. PRAGMA user_version guarda cuántas se han aplicado,
+        así que una casino.db existente se actualiza en el sitio.
+        Una BD creada sin auto_vacuum se convierte aquí, al arrancar: el VACUUM
+        completo reescribe el fichero y con el bot en marcha bloquearía todas
+        las apuestas y liquidaciones mientras dura.
+        """
+        c = conn.cursor()
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(migrations[version:], start=version + 1):
+            c.execute("BEGIN")
+            migration(c)
+            c.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        if c.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            logger.warning("Convirtiendo la BD a auto_vacuum incremental (VACUUM completo, sólo esta vez)")
+            c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            c.execute("VACUUM")
+        c.execute("PRAGMA optimize")
+
+    def vacuum(self, conn, pages: int = 0) -> int:
+        """
+        Devuelve al sistema páginas libres (todas si pages=0). Nunca hace un
+        VACUUM completo: si la BD aún no es incremental (ver migrate) no libera nada.
+        """
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        conn.execute(f"PRAGMA incremental_vacuum({int(pages)})")
+        return free - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+class MemoryStorage(SQLiteStorage):
+    """SQLite en memoria: mismo SQL y mismas migraciones, nada toca el disco ni sobrevive al proceso."""
+
+    name = "memory"
+
+    def __init__(self):
+        super().__init__(":memory:")
+
+    def _configure(self, conn):
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("PRAGMA temp_store=MEMORY")
+
+
+# -------------------------
+# PostgreSQL
+# -------------------------
+class _Row:
+    """Fila con acceso por posición y por nombre, como sqlite3.Row (dict(row) incluido)."""
+
+    __slots__ = ("_names", "_index", "_values")
+
+    def __init__(self, names, index, values):
+        self._names = names
+        self._index = index
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._index[key] if isinstance(key, str) else key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        return list(self._names)
+
+
+def _row_factory(cursor):
+    names = [column.name for column in cursor.description or ()]
+    index = {name: i for i, name in enumerate(names)}
+
+    def make(values):
+        # SUM() de BIGINT devuelve NUMERIC: db.py trabaja con enteros
+        return _Row(names, index, [int(v) if isinstance(v, Decimal) else v for v in values])
+    return make
+
+
+class _PgCursor:
+    """Cursor de psycopg que acepta los `?` de db.py y cuenta filas cambiadas."""
+
+    def __init__(self, conn, cursor):
+        self._conn = conn
+        self._cursor = cursor
+
+    def execute(self, sql, params=()):
+        self._cursor.execute(sql.replace("?", "%s"), params or None)
+        self._count()
+        return self
+
+    def executemany(self, sql, rows):
+        rows = list(rows)
+        if rows:
+            self._cursor.executemany(sql.replace("?", "%s"), rows)
+            self._count()
+        return self
+
+    def _count(self):
+        if self._cursor.rowcount > 0 and self._cursor.description is None:
+            self._conn.total_changes += self._cursor.rowcount
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+
+class _PgConnection:
+    """Conexión prestada por el pool, con la interfaz de sqlite3 que usa db.py."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.total_changes = 0
+
+    def cursor(self):
+        return _PgCursor(self, self.raw.cursor())
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+
+# Esquema PostgreSQL equivalente a cada versión de db.MIGRATIONS: la 7 crea de
+# una vez todo lo que SQLite fue añadiendo hasta su v7.
+POSTGRES_MIGRATIONS = {
+    7: [
+        """CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            balance BIGINT DEFAULT 1000
+        )""",
+        """CREATE TABLE IF NOT EXISTS rounds (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            chat_id BIGINT,
+            status TEXT DEFAULT 'open',
+            result TEXT,
+            settled_at BIGINT
+        )""",
+        """CREATE TABLE IF NOT EXISTS bets (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            chat_id BIGINT,
+            round_id BIGINT,
+            user_id BIGINT,
+            bet_type TEXT,
+            amount BIGINT,
+            mask BIGINT NOT NULL DEFAULT 0,
+            payout INTEGER NOT NULL DEFAULT 0
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_bets_round ON bets (round_id)",
+        # Varios hilos del pool: una segunda ronda abierta en el mismo chat falla en vez de colarse
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_rounds_open ON rounds (chat_id) WHERE status='open'",
+        "CREATE INDEX IF NOT EXISTS idx_rounds_settled ON rounds (settled_at) WHERE status='closed'",
+        "CREATE INDEX IF NOT EXISTS idx_users_balance ON users (balance DESC)",
+        """CREATE TABLE IF NOT EXISTS chat_players (
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS winnings (
+            day TEXT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            amount BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, chat_id, user_id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS transactions (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            ts BIGINT NOT NULL,
+            kind TEXT NOT NULL,
+            user_id BIGINT NOT NULL,
+            counterparty BIGINT,
+            chat_id BIGINT,
+            round_id BIGINT,
+            amount BIGINT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions (user_id, id)",
+        """CREATE TABLE IF NOT EXISTS balance_checkpoints (
+            user_id BIGINT PRIMARY KEY,
+            txn_id BIGINT NOT NULL,
+            balance BIGINT NOT NULL,
+            ts BIGINT NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            rounds BIGINT NOT NULL DEFAULT 0,
+            wagered BIGINT NOT NULL DEFAULT 0,
+            paid BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, chat_id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS daily_numbers (
+            day TEXT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            number INTEGER NOT NULL,
+            hits BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, chat_id, number)
+        )""",
+        "INSERT INTO meta (key, value) VALUES ('ledger_seq', 0) ON CONFLICT DO NOTHING",
+    ],
+    8: [
+        """CREATE TABLE IF NOT EXISTS active_tables (
+            chat_id BIGINT PRIMARY KEY,
+            spin_interval INTEGER NOT NULL,
+            next_spin_at DOUBLE PRECISION NOT NULL,
+            board_message_id BIGINT
+        )""",
+    ],
+    9: [
+        """CREATE TABLE IF NOT EXISTS chat_stats (
+            chat_id BIGINT PRIMARY KEY,
+            spins BIGINT NOT NULL,
+            counts BYTEA NOT NULL,
+            recent BYTEA NOT NULL,
+            color_streak INTEGER NOT NULL,
+            parity_streak INTEGER NOT NULL,
+            best_color_streak INTEGER NOT NULL,
+            best_parity_streak INTEGER NOT NULL
+        )""",
+    ],
+    10: [
+        "DROP INDEX IF EXISTS idx_rounds_settled",
+        "CREATE INDEX IF NOT EXISTS idx_rounds_settled ON rounds (settled_at) WHERE status<>'open'",
+    ],
+}
+
+
+class PostgresStorage:
+    """
+    Servidor PostgreSQL. db.py reparte las llamadas entre `pool_size` hilos y
+    cada llamada toma prestada una conexión del pool (psycopg_pool) y la
+    devuelve al terminar. Varios procesos (shard.py) pueden compartir servidor.
+    """
+
+    name = "postgres"
+
+    def __init__(self, dsn: str, pool_size: int = 4):
+        # Dependencias opcionales: sólo hacen falta con STORAGE_BACKEND=postgres
+        from psycopg_pool import ConnectionPool
+
+        from psycopg import errors
+
+        self.threads = pool_size
+        self.data_errors = (errors.DataError, errors.IntegrityError)
+        self._pool = ConnectionPool(dsn, min_size=pool_size, max_size=pool_size,
+                                    kwargs={"row_factory": _row_factory}, open=True)
+
+    # ---- conexiones ----
+    def acquire(self):
+        return _PgConnection(self._pool.getconn())
+
+    def release(self, conn):
+        from psycopg.pq import TransactionStatus
+
+        # Las funciones que sólo leen no hacen commit: se cierra su transacción
+        if conn.raw.info.transaction_status != TransactionStatus.IDLE:
+            conn.raw.rollback()
+        self._pool.putconn(conn.raw)
+
+    def close(self):
+        self._pool.close()
+
+    # ---- dialecto ----
+    def begin_write(self, c):
+        # Equivale al lock de escritura de SQLite para saldos e historial: espera a
+        # quien esté escribiendo y bloquea a los demás escritores (no a los lectores).
+        # El LOCK va antes de la primera consulta, así la instantánea ya lo incluye.
+        c.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        c.execute("LOCK TABLE users, transactions IN SHARE ROW EXCLUSIVE MODE")
+
+    @staticmethod
+    def day(column: str) -> str:
+        return f"to_char(to_timestamp({column}), 'YYYY-MM-DD')"
+
+    def migrate(self, conn, migrations):
+        c = conn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BIGINT NOT NULL)")
+        conn.commit()
+        if max(POSTGRES_MIGRATIONS) != len(migrations):
+            raise RuntimeError(f"Falta el esquema de PostgreSQL para la migración {len(migrations)} de db.py")
+        # Varios procesos pueden arrancar a la vez: uno migra y los demás esperan
+        c.execute("LOCK TABLE meta IN EXCLUSIVE MODE")
+        row = c.execute("SELECT value FROM meta WHERE key='schema_version'").fetchone()
+        version = row[0] if row else 0
+        for number in sorted(v for v in POSTGRES_MIGRATIONS if v > version):
+            for statement in POSTGRES_MIGRATIONS[number]:
+                c.execute(statement)
+            version = number
+        c.execute("INSERT INTO meta (key, value) VALUES ('schema_version', ?) "
+                  "ON CONFLICT (key) DO UPDATE SET value = excluded.value", (version,))
+        conn.commit()
+
+    def vacuum(self, conn, pages: int = 0) -> int:
+        return 0  # autovacuum del servidor
+
+
+def from_env():
+    """Motor según STORAGE_BACKEND (sqlite, memory, postgres), DB_PATH, DATABASE_URL y DB_POOL_SIZE."""
+    backend = os.getenv("STORAGE_BACKEND", "sqlite").lower()
+    if backend == "sqlite":
+        return SQLiteStorage(Path(os.getenv("DB_PATH", "casino.db")))
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "postgres":
+        dsn = os.getenv("DATABASE_URL")
+        if not dsn:
+            raise RuntimeError("STORAGE_BACKEND=postgres necesita DATABASE_URL")
+        return PostgresStorage(dsn, pool_size=int(os.getenv("DB_POOL_SIZE", "4")))
+    raise RuntimeError(f"STORAGE_BACKEND desconocido: {backend} (usa {', '.join(BACKENDS)})")
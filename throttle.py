@@ -0,0 +1,98 @@
+import time
+from collections import OrderedDict
+
+from ratelimit import TokenBucket
+
+
+class Throttle:
+    """
+    Límite de comandos entrante: una cubeta por usuario y otra por chat.
+
+    - Un comando idéntico al último aceptado del mismo usuario dentro de
+      `merge_seconds` se descarta como repetido (se "funde" con el anterior).
+    - Si no quedan fichas en la cubeta del usuario o del chat, se descarta.
+    - El estado está acotado: LRU de `max_keys` cubetas y, cada `prune_every`
+      segundos, se olvidan las que están llenas (nadie las usa).
+    """
+
+    def __init__(self, user_rate: float = 20 / 60, user_burst: int = 5,
+                 chat_rate: float = 120 / 60, chat_burst: int = 20,
+                 merge_seconds: float = 2.0, max_keys: int = 100_000, prune_every: float = 60.0):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.merge_seconds = merge_seconds
+        self.max_keys = max_keys
+        self.prune_every = prune_every
+        self._buckets = OrderedDict()   # ("u", id) / ("c", id) -> TokenBucket
+        self._last = OrderedDict()      # user_id -> (comando, momento) del último aceptado
+        self._last_prune = time.monotonic()
+        self.allowed = 0
+        self.merged = 0
+        self.dropped_user = 0
+        self.dropped_chat = 0
+        self.evictions = 0
+
+    def allow(self, user_id: int, chat_id: int = None, command: str = None, now: float = None) -> bool:
+        """True si el update pasa. `command` (texto normalizado) permite fundir repeticiones."""
+        now = time.monotonic() if now is None else now
+        if now - self._last_prune > self.prune_every:
+            self._prune(now)
+
+        if command is not None:
+            last = self._last.get(user_id)
+            if last is not None and last[0] == command and now - last[1] < self.merge_seconds:
+                self.merged += 1
+                return False
+
+        user_bucket = self._bucket(("u", user_id), self.user_rate, self.user_burst, now)
+        if user_bucket.take(now):
+            self.dropped_user += 1
+            return False
+        if chat_id is not None and chat_id != user_id:
+            if self._bucket(("c", chat_id), self.chat_rate, self.chat_burst, now).take(now):
+                user_bucket.refund()
+                self.dropped_chat += 1
+                return False
+
+        if command is not None:
+            self._last[user_id] = (command, now)
+            self._last.move_to_end(user_id)
+            if len(self._last) > self.max_keys:
+                self._last.popitem(last=False)
+        self.allowed += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "allowed": self.allowed,
+            "merged": self.merged,
+            "dropped_user": self.dropped_user,
+            "dropped_chat": self.dropped_chat,
+            "buckets": len(self._buckets),
+            "evictions": self.evictions,
+        }
+
+    # ---- internos ----
+    def _bucket(self, key, rate: float, burst: int, now: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, burst, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def _prune(self, now: float):
+        """Una cubeta llena equivale a una nueva: se puede olvidar sin cambiar nada."""
+        idle = [key for key, bucket in self._buckets.items() if bucket.full(now)]
+        for key in idle:
+            del self._buckets[key]
+        self.evictions += len(idle)
+        stale = [uid for uid, (_, at) in self._last.items() if now - at >= self.merge_seconds]
+        for uid in stale:
+            del self._last[uid]
+        self._last_prune = now
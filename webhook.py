@@ -0,0 +1,169 @@
+"""
+Servidor HTTP mínimo (asyncio, sin dependencias) para el modo webhook.
+
+  POST <path>   un Update de Telegram en JSON -> handle_update(dict)
+  GET  /health  estado del bot en JSON
+  GET  <ruta>   rutas extra (`routes`), p. ej. /metrics
+
+También sirve para probar el modo webhook sin Telegram: `replay` envía
+Updates grabados (uno por línea, JSON) al servidor local.
+
+    python webhook.py updates.jsonl http://127.0.0.1:8443/telegram [secreto]
+"""
+import asyncio
+import hmac
+import json
+import logging
+import secrets
+import sys
+import urllib.parse
+import urllib.request
+from http import HTTPStatus
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY = 1 << 20        # 1 MiB; los Updates reales son mucho más pequeños
+READ_TIMEOUT = 30         # segundos esperando una petición en una conexión abierta
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+
+def resolve_secret(secret: str, url: str) -> str:
+    """
+    Secreto que Telegram manda en cada POST. Sin él cualquiera que llegue al
+    puerto podría enviar Updates falsos (p. ej. /dar en nombre de un admin):
+    si falta y el webhook se registra en Telegram (`url`), se genera uno
+    aleatorio para esta ejecución; sin `url` nadie podría conocerlo, así que
+    no se arranca.
+    """
+    if secret:
+        return secret
+    if not url:
+        raise SystemExit("El modo webhook necesita WEBHOOK_SECRET (o WEBHOOK_URL para generar uno)")
+    logger.warning("WEBHOOK_SECRET vacío: se usa uno aleatorio para esta ejecución")
+    return secrets.token_urlsafe(32)
+
+
+class WebhookServer:
+    def __init__(self, handle_update, path: str = "/telegram", secret: str = "",
+                 health=None, max_connections: int = 40, routes: dict = None):
+        if handle_update is not None and not secret:
+            raise ValueError("Un WebhookServer que acepta Updates necesita secreto (ver resolve_secret)")
+        self.handle_update = handle_update   # async callable(dict); None = sin POST
+        self.path = path
+        self.secret = secret
+        self.health = health or (lambda: {})
+        # ruta GET -> callable(query: dict) que devuelve (content_type, cuerpo)
+        self.routes = routes or {}
+        self._slots = asyncio.Semaphore(max_connections)
+        self._server = None
+        self.received = 0
+        self.rejected = 0
+
+    async def start(self, host: str = "0.0.0.0", port: int = 8443):
+        self._server = await asyncio.start_server(self._serve, host, port)
+        return self._server
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    # ---- HTTP ----
+    async def _serve(self, reader, writer):
+        async with self._slots:
+            try:
+                while await self._handle_request(reader, writer):
+                    pass
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                pass
+            except Exception:
+                logger.exception("Error en el servidor webhook")
+            finally:
+                writer.close()
+
+    async def _handle_request(self, reader, writer) -> bool:
+        """Atiende una petición. Devuelve True si la conexión sigue abierta (keep-alive)."""
+        request_line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+        if not request_line:
+            return False
+        try:
+            method, target, version = request_line.decode("latin-1").split()
+        except ValueError:
+            await self._respond(writer, HTTPStatus.BAD_REQUEST, keep_alive=False)
+            return False
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+
+        length = int(headers.get("content-length") or 0)
+        if length > MAX_BODY:
+            await self._respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, keep_alive=False)
+            return False
+        body = await asyncio.wait_for(reader.readexactly(length), READ_TIMEOUT) if length else b""
+
+        path, _, query = target.partition("?")
+        if method == "GET" and path == "/health":
+            payload = json.dumps(dict(status="ok", received=self.received, **self.health()))
+            await self._respond(writer, HTTPStatus.OK, payload, "application/json", keep_alive)
+        elif method == "GET" and path in self.routes:
+            content_type, payload = self.routes[path](dict(urllib.parse.parse_qsl(query)))
+            await self._respond(writer, HTTPStatus.OK, payload, content_type, keep_alive)
+        elif method == "POST" and self.handle_update is not None and path == self.path:
+            # Comparación en tiempo constante: no filtra el secreto por tiempos
+            if not hmac.compare_digest(headers.get(SECRET_HEADER, "").encode(), self.secret.encode()):
+                self.rejected += 1
+                await self._respond(writer, HTTPStatus.FORBIDDEN, keep_alive=keep_alive)
+                return keep_alive
+            try:
+                data = json.loads(body)
+            except ValueError:
+                self.rejected += 1
+                await self._respond(writer, HTTPStatus.BAD_REQUEST, keep_alive=keep_alive)
+                return keep_alive
+            self.received += 1
+            await self.handle_update(data)
+            await self._respond(writer, HTTPStatus.OK, keep_alive=keep_alive)
+        else:
+            await self._respond(writer, HTTPStatus.NOT_FOUND, keep_alive=keep_alive)
+        return keep_alive
+
+    @staticmethod
+    async def _respond(writer, status: HTTPStatus, body: str = "", content_type: str = "text/plain",
+                       keep_alive: bool = True):
+        data = body.encode()
+        writer.write(
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + data
+        )
+        await writer.drain()
+
+
+def replay(path: str, url: str, secret: str = ""):
+    """Envía cada Update grabado en `path` (JSON por línea) al webhook en `url`."""
+    sent = 0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            req = urllib.request.Request(url, data=line.encode(), method="POST",
+                                         headers={"Content-Type": "application/json"})
+            if secret:
+                req.add_header(SECRET_HEADER, secret)
+            with urllib.request.urlopen(req) as resp:
+                resp.read()
+            sent += 1
+    return sent
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        raise SystemExit(__doc__)
+    print(f"{replay(*sys.argv[1:4])} updates enviados")